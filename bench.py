@@ -0,0 +1,302 @@
+"""Offline benchmark for bvd.py.
+
+Starts a local stand-in for a course site and the BunnyCDN player/DRM/HLS
+endpoints, runs download_videos() end-to-end against it and reports
+videos/min, MB/s, time-to-first-byte and per-stage wall time.
+
+    python bench.py
+    python bench.py --scenario 100-lessons lossy -j 4 --engine native
+"""
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import contextlib
+from random import random
+from urllib.parse import urlparse, urljoin
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+import bvd
+
+# latency: seconds added to every response
+# bandwidth: bytes per second per connection for segments
+# error_rate: fraction of segment requests answered with a 503
+SCENARIOS = {
+    "10-lessons": {"lessons": 10, "latency": 0.01, "bandwidth": 20 * 1048576, "error_rate": 0.0},
+    "100-lessons": {"lessons": 100, "latency": 0.01, "bandwidth": 20 * 1048576, "error_rate": 0.0},
+    "1000-lessons": {"lessons": 1000, "latency": 0.01, "bandwidth": 20 * 1048576, "error_rate": 0.0},
+    "lossy": {"lessons": 100, "latency": 0.15, "bandwidth": 1048576, "error_rate": 0.05},
+}
+
+# Renditions served by the mock player, lowest first like the real playlist.drm
+RENDITIONS = ["640x360", "1280x720", "1920x1080"]
+SEGMENT_SECONDS = 4
+
+LIBRARY_ID = "424242"
+SERVER_ID = "bench"
+
+class MockState:
+    """Scenario settings plus what the server has observed"""
+
+    def __init__(self, lessons, latency, bandwidth, error_rate, segments, segment_bytes):
+        self.lessons = lessons
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.segments = segments
+        self.segment_bytes = segment_bytes
+
+        self.lock = threading.Lock()
+        self.embed_at = {}          # guid -> first embed page request
+        self.first_segment_at = {}  # guid -> first segment byte sent
+        self.last_segment_at = {}   # guid -> last segment finished
+        self.bytes_sent = 0
+        self.errors_injected = 0
+
+    def mark(self, table, guid, first=True):
+        with self.lock:
+            if not first or guid not in table:
+                table[guid] = time.time()
+
+def segment_size(state, height):
+    return max(1024, state.segment_bytes * height // 1080)
+
+class MockHandler(BaseHTTPRequestHandler):
+    """Serves the course site, the embed/playlist endpoints, the DRM endpoints and segments"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        state = self.server.state
+        time.sleep(state.latency)
+        path = urlparse(self.path).path
+
+        if path == "/course":
+            links = "".join(f'<li><a href="/lesson/{n}">Lesson {n}</a></li>' for n in range(1, state.lessons + 1))
+            return self._send(f'<html><body><a href="/about">About</a><ul>{links}</ul></body></html>')
+
+        match = re.fullmatch(r"/lesson/(\d+)", path)
+        if match:
+            guid = f"guid-{int(match.group(1)):05d}"
+            return self._send(
+                f'<html><body><h1>Lesson {match.group(1)}</h1>'
+                f'<iframe src="https://iframe.mediadelivery.net/embed/{LIBRARY_ID}/{guid}?autoplay=false"></iframe>'
+                f'</body></html>'
+            )
+
+        match = re.fullmatch(r"/embed/\d+/(guid-\d+)", path)
+        if match:
+            guid = match.group(1)
+            state.mark(state.embed_at, guid)
+            return self._send(
+                f'<html><head><meta property="og:title" content="{guid}.mp4"></head><body>'
+                f'<script src="https://video-{SERVER_ID}.mediadelivery.net/player.js"></script>'
+                f'<video src="/{guid}/playlist.drm?contextId=ctx-{guid}&secret=secret-{guid}"></video>'
+                f'</body></html>'
+            )
+
+        if re.fullmatch(r"/_video/[^/]+/\.drm/[^/]+/(ping|activate)", path):
+            return self._send("")
+
+        match = re.fullmatch(r"/(guid-\d+)/playlist\.drm", path)
+        if match:
+            lines = ["#EXTM3U"]
+            for resolution in RENDITIONS:
+                # Declare the bitrate the synthetic segments actually have, so size checks pass
+                bandwidth = segment_size(state, int(resolution.split("x")[1])) * 8 // SEGMENT_SECONDS
+                lines += [f"#EXT-X-STREAM-INF:BANDWIDTH={bandwidth},RESOLUTION={resolution}", f"{resolution}/video.drm"]
+            return self._send("\n".join(lines) + "\n")
+
+        match = re.fullmatch(r"/(guid-\d+)/([^/]+)/video\.drm", path)
+        if match:
+            lines = ["#EXTM3U", "#EXT-X-VERSION:7", f"#EXT-X-TARGETDURATION:{SEGMENT_SECONDS}", '#EXT-X-MAP:URI="init.mp4"']
+            for n in range(state.segments):
+                lines += [f"#EXTINF:{SEGMENT_SECONDS}.000,", f"seg-{n}.m4s"]
+            lines.append("#EXT-X-ENDLIST")
+            return self._send("\n".join(lines) + "\n")
+
+        match = re.fullmatch(r"/(guid-\d+)/([^/]+)/init\.mp4", path)
+        if match:
+            return self._send(b"\x00" * 1024, content_type="video/mp4")
+
+        match = re.fullmatch(r"/(guid-\d+)/(\d+)x(\d+)/seg-(\d+)\.m4s", path)
+        if match:
+            return self._send_segment(state, match.group(1), int(match.group(3)), int(match.group(4)))
+
+        self.send_error(404)
+
+    def _send(self, body, content_type="text/html"):
+        if isinstance(body, str):
+            body = body.encode("utf8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_segment(self, state, guid, height, index):
+        if random() < state.error_rate:
+            with state.lock:
+                state.errors_injected += 1
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        size = segment_size(state, height)
+        self.send_response(200)
+        self.send_header("Content-Type", "video/mp4")
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+
+        state.mark(state.first_segment_at, guid)
+        chunk = bytes([index % 256]) * 16384
+        sent = 0
+        while sent < size:
+            part = chunk[:min(len(chunk), size - sent)]
+            self.wfile.write(part)
+            sent += len(part)
+            time.sleep(len(part) / state.bandwidth)
+
+        with state.lock:
+            state.bytes_sent += size
+        state.mark(state.last_segment_at, guid, first=False)
+
+class HttpBrowser:
+    """Stand-in for ChromeBrowser that reads the mock course site over plain HTTP"""
+
+    def __init__(self):
+        self.session = requests.Session()
+
+    def get_page_links(self, url, base_url, **options):
+        html = self.session.get(url, timeout=30).text
+        links = [urljoin(url, href) for href in re.findall(r'href="([^"]+)"', html)]
+        return list(dict.fromkeys(link for link in links if base_url in link))
+
+    def iter_embed_urls(self, page_urls, tabs=1):
+        def resolve(page_url):
+            return bvd.extract_embed_url_from_html(self.session.get(page_url, timeout=30).text)
+
+        with ThreadPoolExecutor(max_workers=max(1, tabs)) as executor:
+            futures = {executor.submit(resolve, page_url): page_url for page_url in page_urls}
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+
+    def get_cookies(self):
+        return []
+
+    def get_user_agent(self):
+        return None
+
+    def cleanup(self):
+        self.session.close()
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def run_scenario(name, config, args):
+    """Run download_videos against a fresh mock server and return its measurements"""
+    state = MockState(segments=args.segments, segment_bytes=args.segment_kb * 1024, **config)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockHandler)
+    server.daemon_threads = True
+    server.state = state
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    origin = f"http://127.0.0.1:{server.server_address[1]}"
+
+    bvd.metrics = bvd.Metrics()  # Fresh span totals for every scenario
+    bvd.BunnyVideoDRM.iframe_origin = origin
+    bvd.BunnyVideoDRM.video_origin = origin + "/_video/{server_id}"
+    bvd.probe_duration = lambda file_path: None  # Synthetic segments aren't playable video
+    output = tempfile.mkdtemp(prefix="bvd-bench-")
+
+    print(f"Running {name}: {config['lessons']} lessons, {config['latency'] * 1000:.0f} ms latency, "
+          f"{config['bandwidth'] / 1048576:.1f} MB/s per connection, {config['error_rate']:.0%} errors")
+    try:
+        start = time.time()
+        log = sys.stdout if args.verbose else open(os.devnull, "w")
+        with contextlib.redirect_stdout(log):
+            result = bvd.download_videos(
+                f"{origin}/course", "/lesson/",
+                output_path=output,
+                jobs=args.jobs,
+                max_connections=args.max_connections,
+                tabs=args.tabs,
+                use_cache=False,
+                engine=args.engine,
+                rate_limiter=bvd.RateLimiter.parse(args.max_rate),
+                browser=HttpBrowser()
+            )
+        wall = time.time() - start
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(output, ignore_errors=True)
+
+    result = result or {}
+    ttfb = [state.first_segment_at[g] - state.embed_at[g] for g in state.first_segment_at if g in state.embed_at]
+    segment_time = [state.last_segment_at[g] - state.first_segment_at[g] for g in state.last_segment_at]
+    discovery = result.get("discovery")
+    return {
+        "scenario": name,
+        "lessons": config["lessons"],
+        "successful": result.get("successful", 0),
+        "failed": result.get("failed", 0),
+        "wall_seconds": wall,
+        "videos_per_min": result.get("successful", 0) / wall * 60 if wall else 0.0,
+        "mb_per_s": state.bytes_sent / 1048576 / wall if wall else 0.0,
+        "ttfb_avg": sum(ttfb) / len(ttfb) if ttfb else 0.0,
+        "ttfb_p95": percentile(ttfb, 0.95),
+        "discovery_seconds": (discovery.finished - discovery.started) if discovery and discovery.started else 0.0,
+        "segments_avg_seconds": sum(segment_time) / len(segment_time) if segment_time else 0.0,
+        "errors_injected": state.errors_injected,
+        "stages": {name: round(totals[1], 3) for name, totals in bvd.metrics.spans.items()},
+    }
+
+def print_report(results):
+    header = f"{'scenario':<14}{'ok/total':>10}{'wall s':>9}{'vid/min':>9}{'MB/s':>8}{'TTFB avg':>10}{'TTFB p95':>10}{'discov s':>10}{'seg s':>8}{'503s':>6}"
+    print("\n" + header)
+    print("-" * len(header))
+    for r in results:
+        print(f"{r['scenario']:<14}{r['successful']:>5}/{r['lessons']:<4}{r['wall_seconds']:>9.1f}{r['videos_per_min']:>9.1f}"
+              f"{r['mb_per_s']:>8.2f}{r['ttfb_avg']:>10.3f}{r['ttfb_p95']:>10.3f}{r['discovery_seconds']:>10.1f}"
+              f"{r['segments_avg_seconds']:>8.2f}{r['errors_injected']:>6}")
+    print("\nSeconds per stage, summed over all videos:")
+    for r in results:
+        stages = sorted(r["stages"].items(), key=lambda item: item[1], reverse=True)
+        print(f"{r['scenario']:<14}" + ", ".join(f"{name} {seconds:.1f}" for name, seconds in stages))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark bvd.py against a local mock BunnyCDN and course site")
+    parser.add_argument("--scenario", nargs="+", choices=list(SCENARIOS), help="Scenarios to run (default: all)")
+    parser.add_argument("-j", "--jobs", type=int, help="Parallel downloads (default: 4)", default=4)
+    parser.add_argument("--tabs", type=int, help="Parallel lesson page fetches (default: 4)", default=4)
+    parser.add_argument("--max-connections", type=int, help="Total fragment connections (default: 32)", default=32)
+    parser.add_argument("--engine", choices=["yt-dlp", "native"], help="Segment downloader (default: native)", default="native")
+    parser.add_argument("--segments", type=int, help="Segments per video (default: 5)", default=5)
+    parser.add_argument("--segment-kb", type=int, help="Size of a 1080p segment in KB (default: 64)", default=64)
+    parser.add_argument("--max-rate", help="Total download rate limit, e.g. 2M (default: unlimited)")
+    parser.add_argument("--json", help="Also write the results to this JSON file")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Show the downloader's own output")
+
+    args = parser.parse_args()
+
+    results = [run_scenario(name, SCENARIOS[name], args) for name in (args.scenario or SCENARIOS)]
+    print_report(results)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
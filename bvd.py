@@ -1,20 +1,510 @@
+import time
+_started = _process_started = time.perf_counter()
+
+import os
 import re
 import sys
-import time
+import json
+import shutil
+import sqlite3
+import subprocess
+import importlib
+import queue
 import argparse
-from urllib.parse import urlparse
-from hashlib import md5
+import threading
+import contextlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse, urljoin
+from hashlib import md5, sha256
 from html import unescape
 from random import random
 
+# Seconds spent importing each dependency, for --profile-startup
+import_times = {"stdlib": time.perf_counter() - _started}
+
+_started = time.perf_counter()
 import requests
-import yt_dlp
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.common.exceptions import TimeoutException
+from requests.adapters import HTTPAdapter
+import_times["requests"] = time.perf_counter() - _started
+
+class LazyImport:
+    """Stands in for a module (or one of its attributes) until first used.
+
+    yt-dlp and Selenium together take around half a second to import, and
+    many runs only need one of them or neither, e.g. with every embed
+    already cached. The import happens on first attribute access or call,
+    and its duration is recorded in import_times.
+    """
+
+    def __init__(self, module, attribute=None):
+        self._module = module
+        self._attribute = attribute
+        self._target = None
+
+    def _load(self):
+        if self._target is None:
+            start = time.perf_counter()
+            target = importlib.import_module(self._module)
+            if self._module not in import_times:
+                import_times[self._module] = time.perf_counter() - start
+            self._target = getattr(target, self._attribute) if self._attribute else target
+        return self._target
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+
+def startup_report():
+    """Return lines describing the time spent importing each dependency so far"""
+    lines = [f"{name:<36}{seconds * 1000:8.1f} ms" for name, seconds in import_times.items()]
+    lines.append(f"{'total imports':<36}{sum(import_times.values()) * 1000:8.1f} ms")
+    lines.append(f"{'ready (since bvd started loading)':<36}{(time.perf_counter() - _process_started) * 1000:8.1f} ms")
+    return lines
+
+yt_dlp = LazyImport("yt_dlp")
+webdriver = LazyImport("selenium.webdriver")
+Options = LazyImport("selenium.webdriver.chrome.options", "Options")
+By = LazyImport("selenium.webdriver.common.by", "By")
+WebDriverWait = LazyImport("selenium.webdriver.support.ui", "WebDriverWait")
+# except clauses need the real class, so look it up when the exception is caught
+selenium_exceptions = LazyImport("selenium.common.exceptions")
+
+class Metrics:
+    """Timing spans and counters for every stage of a run.
+
+    Each finished span is written as one JSON line, if a JSON-lines file is
+    configured. Counters are only added up in memory, since some go up on
+    every chunk downloaded; what they gained is written out every few
+    seconds, one line per counter. Span totals and counters can also be
+    exported in Prometheus text format, to a file rewritten every few
+    seconds and/or over HTTP at /metrics.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.jsonl = None
+        self.prom_path = None
+        self.server = None
+        self.flusher = None
+        self.stopped = threading.Event()
+        self.spans = {}     # span name -> [count, total seconds, errors]
+        self.counters = {}  # (name, labels) -> value
+        self.unwritten = {}  # (name, labels) -> increase since the last JSON line
+
+    def configure(self, jsonl_path=None, prom_path=None, port=None, interval=10):
+        """Turn on the outputs that were asked for"""
+        if jsonl_path:
+            self.jsonl = open(jsonl_path, "a")
+        if prom_path:
+            self.prom_path = prom_path
+        if jsonl_path or prom_path:
+            self.flusher = threading.Thread(target=self._flush_loop, args=(interval,), name="metrics", daemon=True)
+            self.flusher.start()
+        if port:
+            from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+            metrics = self
+
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    body = metrics.prometheus_text().encode("utf8")
+                    self.send_response(200 if self.path == "/metrics" else 404)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    pass
+
+            self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+            threading.Thread(target=self.server.serve_forever, name="metrics-http", daemon=True).start()
+            print(f"Serving metrics on http://127.0.0.1:{port}/metrics")
+
+    @contextlib.contextmanager
+    def span(self, name, **fields):
+        """Time the enclosed block as one span"""
+        start = time.time()
+        error = None
+        try:
+            yield
+        except Exception as e:
+            error = str(e)
+            raise
+        finally:
+            self.record_span(name, time.time() - start, start=start, error=error, **fields)
+
+    def record_span(self, name, duration, start=None, error=None, **fields):
+        """Record a span that was timed elsewhere"""
+        with self.lock:
+            totals = self.spans.setdefault(name, [0, 0.0, 0])
+            totals[0] += 1
+            totals[1] += duration
+            if error:
+                totals[2] += 1
+        record = {"type": "span", "name": name, "start": start or time.time() - duration,
+                  "duration": round(duration, 6), **fields}
+        if error:
+            record["error"] = error
+        self._emit(record)
+
+    def count(self, name, value=1, **labels):
+        """Add to a counter; labels should have few distinct values"""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+            self.unwritten[key] = self.unwritten.get(key, 0) + value
+
+    def _emit(self, record):
+        if not self.jsonl:
+            return
+        line = json.dumps(record, default=str)
+        with self.lock:
+            self.jsonl.write(line + "\n")
+
+    def write_counters(self):
+        """Write one JSON line per counter that went up since the last call, and flush the file"""
+        with self.lock:
+            unwritten, self.unwritten = self.unwritten, {}
+            if not self.jsonl:
+                return
+            now = time.time()
+            for (name, labels), value in sorted(unwritten.items()):
+                record = {"type": "counter", "name": name, "value": value, "total": self.counters[(name, labels)],
+                          "time": now, **dict(labels)}
+                self.jsonl.write(json.dumps(record, default=str) + "\n")
+            self.jsonl.flush()
+
+    def prometheus_text(self):
+        """Render span totals and counters in Prometheus text format"""
+        with self.lock:
+            spans = {name: list(totals) for name, totals in self.spans.items()}
+            counters = dict(self.counters)
+
+        lines = ["# TYPE bvd_span_seconds summary"]
+        for name, (count, total, _) in sorted(spans.items()):
+            lines.append(f'bvd_span_seconds_sum{{span="{name}"}} {total:.6f}')
+            lines.append(f'bvd_span_seconds_count{{span="{name}"}} {count}')
+        lines.append("# TYPE bvd_span_errors_total counter")
+        for name, (_, _, errors) in sorted(spans.items()):
+            lines.append(f'bvd_span_errors_total{{span="{name}"}} {errors}')
+
+        typed = set()
+        for (name, labels), value in sorted(counters.items()):
+            metric = f"bvd_{name}_total"
+            if metric not in typed:
+                lines.append(f"# TYPE {metric} counter")
+                typed.add(metric)
+            label_text = ",".join(f'{k}="{v}"' for k, v in labels)
+            lines.append(f"{metric}{{{label_text}}} {value}" if label_text else f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self):
+        if not self.prom_path:
+            return
+        temp_path = f"{self.prom_path}.tmp"
+        with open(temp_path, "w") as f:
+            f.write(self.prometheus_text())
+        os.replace(temp_path, self.prom_path)
+
+    def _flush_loop(self, interval):
+        while not self.stopped.wait(interval):
+            self.write_counters()
+            self.write_prometheus()
+
+    def summary(self):
+        """Return one line per span with its count and total time, slowest first"""
+        with self.lock:
+            spans = sorted(self.spans.items(), key=lambda item: item[1][1], reverse=True)
+        return [f"{name}: {count}x, {total:.1f}s total, {total / count:.2f}s avg"
+                for name, (count, total, _) in spans if count]
+
+    def close(self):
+        self.stopped.set()
+        self.write_counters()
+        self.write_prometheus()
+        if self.server:
+            self.server.shutdown()
+            self.server = None
+        if self.jsonl:
+            self.jsonl.close()
+            self.jsonl = None
+
+# Shared by everything in the process; outputs are off until configure() is called
+metrics = Metrics()
+
+def parse_size(text, unit=1024):
+    """Parse sizes like "700M", "20G" or "3.5k" into a number"""
+    match = re.fullmatch(r"\s*([\d.]+)\s*([kmgt]?)i?b?\s*", text.lower())
+    if not match:
+        raise ValueError(f"Invalid size: {text}")
+    return int(float(match.group(1)) * unit ** " kmgt".index(match.group(2) or " "))
+
+def format_rate(rate):
+    """Format a rate limit in bytes per second; None means no limit"""
+    return f"{rate / 1048576:.1f} MB/s" if rate else "unlimited"
+
+def parse_master_playlist(text):
+    """Return the renditions in a master playlist, highest first.
+
+    Each rendition is a dict with resolution (the playlist path, e.g.
+    "1280x720"), height, and bandwidth (the declared peak) and
+    average_bandwidth in bits per second, 0 when not declared.
+    """
+    renditions = []
+    attributes = {}
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith("#EXT-X-STREAM-INF:"):
+            attributes = dict(re.findall(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)', line.split(":", 1)[1]))
+        elif line and not line.startswith("#") and "/video.drm" in line:
+            resolution = line.split("/video.drm")[0].strip().split("/")[-1]
+            size = re.search(r"(\d+)x(\d+)|(\d+)p$", attributes.get("RESOLUTION", "") or resolution)
+            renditions.append({
+                "resolution": resolution,
+                "height": int(size.group(2) or size.group(3)) if size else 0,
+                "bandwidth": int(attributes["BANDWIDTH"]) if attributes.get("BANDWIDTH", "").isdigit() else 0,
+                "average_bandwidth": int(attributes.get("AVERAGE-BANDWIDTH", "")) if attributes.get(
+                    "AVERAGE-BANDWIDTH", "").isdigit() else 0,
+            })
+            attributes = {}
+    # Playlists list renditions lowest first, so that's the tie-breaker
+    return sorted(renditions[::-1], key=lambda r: (r["height"], r["bandwidth"]), reverse=True)
+
+def playlist_duration(text):
+    """Sum the segment durations of a media playlist, in seconds"""
+    return sum(float(d) for d in re.findall(r"#EXTINF:\s*([\d.]+)", text))
+
+class StreamVerifier:
+    """Checks a download against its media playlist while it is being written.
+
+    Bytes are hashed on their way to disk, so the checksum costs no second
+    read of a multi-GB file. problems() then compares what was written with
+    what the playlist declared: every segment, their total duration and
+    the number of bytes that ended up in the file.
+    """
+
+    def __init__(self, segments):
+        self.hash = sha256()
+        self.expected_segments = len(segments)
+        self.declared_duration = sum(segment["duration"] for segment in segments)
+        self.remuxed = False
+        self.segments = 0
+        self.duration = 0.0
+        self.bytes = 0
+
+    def resume(self, f, length, segments):
+        """Account for the part of a file written by an earlier run.
+
+        The hash can't be saved between runs, so the existing prefix is read
+        once; a fresh download never reads anything back.
+        """
+        f.seek(0)
+        while self.bytes < length:
+            chunk = f.read(min(1048576, length - self.bytes))
+            if not chunk:
+                break
+            self.update(chunk)
+        for segment in segments:
+            self.segments += 1
+            self.duration += segment["duration"]
+
+    def update(self, data, segment=None):
+        self.hash.update(data)
+        self.bytes += len(data)
+        if segment is not None:
+            self.segments += 1
+            self.duration += segment["duration"]
+
+    def problems(self):
+        problems = []
+        if self.segments != self.expected_segments:
+            problems.append(f"{self.segments} of {self.expected_segments} segments written")
+        if abs(self.duration - self.declared_duration) > 0.5:
+            problems.append(f"{self.duration:.1f}s of {self.declared_duration:.1f}s written")
+        return problems
+
+def probe_duration(file_path):
+    """Return the container duration of a video in seconds using ffprobe.
+
+    Only the file's headers are read. Returns None if ffprobe isn't
+    installed, and raises if it can't make sense of the file.
+    """
+    ffprobe = shutil.which("ffprobe")
+    if not ffprobe:
+        return None
+    result = subprocess.run(
+        [ffprobe, "-v", "error", "-show_entries", "format=duration", "-of", "default=nw=1:nk=1", file_path],
+        capture_output=True, text=True
+    )
+    try:
+        return float(result.stdout.strip())
+    except ValueError:
+        raise Exception(f"ffprobe can't read the file: {result.stderr.strip() or 'no duration'}")
+
+def sidecar_path(file_path):
+    return f"{file_path}.bvd.json"
+
+def write_sidecar(file_path, record):
+    """Store a verification record next to the video, stamped with its current size and mtime"""
+    stat = os.stat(file_path)
+    record = dict(record, size=stat.st_size, mtime_ns=stat.st_mtime_ns, verified_at=time.time())
+    temp_path = f"{sidecar_path(file_path)}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(record, f, indent=1)
+    os.replace(temp_path, sidecar_path(file_path))
+    return record
+
+def read_sidecar(file_path):
+    """Return the verification record of a video if the file hasn't changed since, else None.
+
+    Only the sidecar and the file's size and mtime are checked, never its contents.
+    """
+    try:
+        with open(sidecar_path(file_path)) as f:
+            record = json.load(f)
+        stat = os.stat(file_path)
+    except (OSError, ValueError):
+        return None
+    if record.get("size") != stat.st_size or record.get("mtime_ns") != stat.st_mtime_ns:
+        return None
+    return record
+
+def verified_file(file_path, size=None):
+    """Whether a finished video can be skipped: it matches its sidecar or,
+    for files downloaded before sidecars existed, the recorded size"""
+    if not file_path or not os.path.isfile(file_path):
+        return False
+    if os.path.exists(sidecar_path(file_path)):
+        return read_sidecar(file_path) is not None
+    return size is not None and os.path.getsize(file_path) == size
+
+class QualityPolicy:
+    """Chooses which rendition to download instead of always taking the highest.
+
+    The spec is a comma separated list of limits, e.g. "maxheight=720",
+    "maxbitrate=3M" or "budget=50G". With a budget, the remaining bytes are
+    shared out evenly between the videos that haven't started yet, using
+    each rendition's declared BANDWIDTH and the video's duration.
+    """
+
+    def __init__(self, max_height=None, max_bitrate=None, budget=None):
+        self.max_height = max_height
+        self.max_bitrate = max_bitrate
+        self.budget = budget
+        self.remaining_bytes = budget
+        self.remaining_videos = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def parse(cls, spec):
+        """Build a policy from a --quality spec; "best" or empty means no limits"""
+        limits = {}
+        for part in filter(None, (p.strip() for p in (spec or "").split(","))):
+            if part == "best":
+                continue
+            key, _, value = part.partition("=")
+            if key not in ("maxheight", "maxbitrate", "budget"):
+                raise ValueError(f"Unknown quality limit: {part}")
+            try:
+                if key == "maxheight":
+                    limits["max_height"] = int(value.rstrip("p"))
+                elif key == "maxbitrate":
+                    limits["max_bitrate"] = parse_size(value, unit=1000)
+                else:
+                    limits["budget"] = parse_size(value)
+            except ValueError:
+                raise ValueError(f"Invalid quality limit: {part}")
+        return cls(**limits)
+
+    @property
+    def needs_duration(self):
+        return self.budget is not None
+
+    def add_videos(self, count):
+        """Tell the policy how many more videos will share the budget"""
+        with self.lock:
+            self.remaining_videos = max(0, self.remaining_videos + count)
+
+    def choose(self, renditions, duration=None):
+        """Pick the highest rendition that satisfies every limit, or the lowest if none does"""
+        with self.lock:
+            allowance = None
+            if self.budget is not None:
+                allowance = max(0, self.remaining_bytes) / max(1, self.remaining_videos)
+
+            chosen = renditions[-1]
+            for rendition in renditions:
+                estimate = rendition["bandwidth"] / 8 * duration if duration and rendition["bandwidth"] else None
+                rendition["estimated_bytes"] = estimate
+                if self.max_height and rendition["height"] > self.max_height:
+                    continue
+                if self.max_bitrate and rendition["bandwidth"] > self.max_bitrate:
+                    continue
+                if allowance is not None and estimate and estimate > allowance:
+                    continue
+                chosen = rendition
+                break
+
+            if self.budget is not None:
+                self.remaining_videos = max(0, self.remaining_videos - 1)
+                self.remaining_bytes -= chosen.get("estimated_bytes") or 0
+
+        estimate = chosen.get("estimated_bytes")
+        print(f"Selected {chosen['resolution']} ({chosen['bandwidth'] / 1e6:.1f} Mbps"
+              + (f", ~{estimate / 1048576:.0f} MB" if estimate else "") + ")")
+        return chosen
+
+    def settle(self, estimated_bytes, actual_bytes):
+        """Replace a video's estimate with the bytes it actually took"""
+        if self.budget is None or not estimated_bytes:
+            return
+        with self.lock:
+            self.remaining_bytes += estimated_bytes - actual_bytes
+
+    def summary(self):
+        if self.budget is None:
+            return None
+        used = self.budget - self.remaining_bytes
+        return f"Size budget: {used / 1073741824:.2f} GB of {self.budget / 1073741824:.2f} GB used"
+
+class SessionPool:
+    """Hands out requests sessions that share one set of keep-alive connection pools.
+
+    Every session gets its own cookies and headers, but all of them are
+    mounted on the same HTTPAdapter, so connections to iframe.mediadelivery.net
+    and the video servers are reused across videos instead of paying a new
+    TCP and TLS handshake each time. urllib3's pools are thread-safe, and the
+    pool is owned by the run: close it once, after every session is done.
+    """
+
+    def __init__(self, hosts=16, per_host=32):
+        self.adapter = HTTPAdapter(pool_connections=max(1, hosts), pool_maxsize=max(1, per_host))
+
+    def session(self, headers=None):
+        """Return a new session on the shared connections. Don't close it; close the pool"""
+        session = requests.Session()
+        session.mount("https://", self.adapter)
+        session.mount("http://", self.adapter)
+        if headers:
+            session.headers.update(headers)
+        return session
+
+    def summary(self):
+        """Return a one-line description of how much the connections were reused"""
+        pools = self.adapter.poolmanager.pools
+        connections = requests_made = 0
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                connections += pool.num_connections
+                requests_made += pool.num_requests
+        return f"Connections: {connections} opened for {requests_made} requests to {len(pools)} hosts"
+
+    def close(self):
+        self.adapter.close()
 
 class BunnyVideoDRM:
     """Handles the BunnyCDN video DRM and download functionality"""
@@ -25,12 +515,24 @@ class BunnyVideoDRM:
         "user-agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/107.0.0.0 Safari/537.36",
     }
 
-    def __init__(self, referer, embed_url, name="", path=""):
-        self.session = requests.Session()
+    # Where the player and DRM endpoints live; overridden to point at a local server for benchmarks
+    iframe_origin = "https://iframe.mediadelivery.net"
+    video_origin = "https://video-{server_id}.mediadelivery.net"
+
+    def __init__(self, referer, embed_url, name="", path="", sessions=None, cancelled=None, rate_limiter=None,
+                 rate_group=None):
+        # Sessions from a shared pool are left open for the next video
+        self.owns_session = sessions is None
+        self.session = requests.Session() if self.owns_session else sessions.session()
         self.session.headers.update(self.user_agent)
 
         self.referer = referer
         self.embed_url = embed_url
+        self.cancelled = cancelled  # threading.Event set when the video's job is cancelled
+        self.rate_limiter = rate_limiter
+        self.rate_group = rate_group  # Job whose per-job bandwidth limit applies
+        self.downloaded_bytes = 0
+        self.error = None
         self.guid = urlparse(embed_url).path.split("/")[-1]
         self.path = path if path else "."
 
@@ -89,12 +591,21 @@ class BunnyVideoDRM:
             except:
                 # Use a fallback name based on GUID
                 self.file_name = f"video_{self.guid}.mp4"
+        # Names come from batch files, API requests and page titles: keep them inside the output directory
+        self.file_name = re.sub(r"[/\\\0]", "_", self.file_name).lstrip(".") or f"video_{self.guid}.mp4"
 
     def _fetch_video_metadata(self):
         """Fetch video metadata from the embed page"""
+        with metrics.span("fetch_video_metadata", guid=self.guid):
+            self._fetch_embed_page()
+
+    def _fetch_embed_page(self):
         try:
             # Get the embed page
-            embed_response = self.session.get(self.embed_url, headers=self.headers["embed"])
+            embed_response = self.session.get(
+                self.embed_url.replace("https://iframe.mediadelivery.net", self.iframe_origin, 1),
+                headers=self.headers["embed"]
+            )
             self.embed_page = embed_response.text
 
             # Extract server ID
@@ -116,50 +627,82 @@ class BunnyVideoDRM:
             print(f"Error fetching video metadata: {e}")
             raise
 
-    def prepare_dl(self):
+    def prepare_dl(self, preferred_resolution=None, policy=None):
         """Prepare video for downloading by activating the DRM and getting video metadata"""
         try:
             # Function to ping the server
             def ping(time_val, paused, res):  # Changed parameter name from time to time_val
+                with metrics.span("prepare_dl.ping", guid=self.guid):
+                    _ping(time_val, paused, res)
+
+            def _ping(time_val, paused, res):
                 md5_hash = md5(f"{self.secret}_{self.context_id}_{time_val}_{paused}_{res}".encode("utf8")).hexdigest()
                 params = {"hash": md5_hash, "time": time_val, "paused": paused, "chosen_res": res}
                 self.session.get(
-                    f"https://video-{self.server_id}.mediadelivery.net/.drm/{self.context_id}/ping",
+                    f"{self.video_origin.format(server_id=self.server_id)}/.drm/{self.context_id}/ping",
                     params=params, headers=self.headers["ping|activate"]
                 )
 
             # Function to activate the video
             def activate():
+                with metrics.span("prepare_dl.activate", guid=self.guid):
+                    _activate()
+
+            def _activate():
                 self.session.get(
-                    f"https://video-{self.server_id}.mediadelivery.net/.drm/{self.context_id}/activate",
+                    f"{self.video_origin.format(server_id=self.server_id)}/.drm/{self.context_id}/activate",
                     headers=self.headers["ping|activate"]
                 )
 
             # Function to get the main playlist
             def main_playlist():
+                with metrics.span("prepare_dl.main_playlist", guid=self.guid):
+                    return _main_playlist()
+
+            def _main_playlist():
                 params = {"contextId": self.context_id, "secret": self.secret}
                 response = self.session.get(
-                    f"https://iframe.mediadelivery.net/{self.guid}/playlist.drm",
+                    f"{self.iframe_origin}/{self.guid}/playlist.drm",
                     params=params, headers=self.headers["playlist"]
                 )
-                resolutions = re.findall(r"\s*(.*?)\s*/video\.drm", response.text)[::-1]
-                if not resolutions:
+                renditions = parse_master_playlist(response.text)
+                if not renditions:
                     raise Exception("No resolutions found in playlist")
-                return resolutions[0]  # Return highest resolution
+                for rendition in renditions:
+                    if rendition["resolution"] == preferred_resolution:
+                        self.bandwidth, self.average_bandwidth = rendition["bandwidth"], rendition["average_bandwidth"]
+                        return preferred_resolution  # Same rendition as an interrupted download
+                if not policy:
+                    self.bandwidth, self.average_bandwidth = renditions[0]["bandwidth"], renditions[0]["average_bandwidth"]
+                    return renditions[0]["resolution"]  # Return highest resolution
+
+                duration = None
+                if policy.needs_duration:
+                    # Every rendition has the same runtime, so read it from the smallest playlist
+                    duration = playlist_duration(video_playlist(renditions[-1]["resolution"]))
+                rendition = policy.choose(renditions, duration)
+                self.estimated_bytes = rendition.get("estimated_bytes")
+                self.bandwidth, self.average_bandwidth = rendition["bandwidth"], rendition["average_bandwidth"]
+                return rendition["resolution"]
 
             # Function to get the video playlist
             def video_playlist(resolution):
+                with metrics.span("prepare_dl.video_playlist", guid=self.guid, resolution=resolution):
+                    return _video_playlist(resolution)
+
+            def _video_playlist(resolution):
                 params = {"contextId": self.context_id}
-                self.session.get(
-                    f"https://iframe.mediadelivery.net/{self.guid}/{resolution}/video.drm",
+                response = self.session.get(
+                    f"{self.iframe_origin}/{self.guid}/{resolution}/video.drm",
                     params=params, headers=self.headers["playlist"]
                 )
+                return response.text
 
             # Execute the DRM preparation sequence
             ping(time_val=0, paused="true", res="0")  # Changed time to time_val
             activate()
             resolution = main_playlist()
-            video_playlist(resolution)
+            self.declared_duration = playlist_duration(video_playlist(resolution))
 
             # Simulate video playback to keep the DRM happy
             for i in range(0, 29, 4):
@@ -171,61 +714,1535 @@ class BunnyVideoDRM:
             print(f"Error preparing download: {e}")
             raise
 
-    def download(self):
-        """Download the video using yt-dlp"""
+    def download(self, budget=None, concurrent_fragments=10, show_progress=True, manifest=None, resume=False,
+                 backend=None, policy=None, disk=None):
+        """Download the video with the given backend (yt-dlp by default).
+
+        Progress is recorded in the job manifest, if given. With resume=True,
+        an interrupted download continues from its last completed fragment.
+        """
+        self.budget = budget
+        self.granted = 0
+        self.downloaded_bytes = 0
+        self.estimated_bytes = None
+        self.bandwidth = None
+        self.average_bandwidth = None
+        self.declared_duration = None
+        self.stream = None  # StreamVerifier, if the backend hashed the data as it wrote it
+        self.checksum = None
+        self.output_file = os.path.join(self.path, self.file_name)
+        self.manifest = manifest
+        backend = backend or YtDlpBackend()
         try:
+            self._check_cancelled()
             print(f"Preparing video for download...")
-            resolution = self.prepare_dl()
-
-            url = f"https://iframe.mediadelivery.net/{self.guid}/{resolution}/video.drm?contextId={self.context_id}"
+            previous = manifest.get(self.guid) if manifest and resume else {}
+            with metrics.span("prepare_dl", guid=self.guid):
+                resolution = self.prepare_dl(preferred_resolution=previous.get("resolution"), policy=policy)
+            self.resolution = resolution
+            if previous.get("resolution") != resolution:
+                # Fragment positions only make sense in the rendition they were saved for
+                if previous.get("fragment_index"):
+                    print(f"Resolution changed from {previous.get('resolution')} to {resolution}, starting over")
+                previous = {}
+            if manifest:
+                # Clear the fragment progress of an earlier run unless we resume it
+                manifest.update(self.guid, state="prepared", resolution=resolution,
+                                fragment_index=previous.get("fragment_index"),
+                                fragment_count=previous.get("fragment_count"),
+                                bytes_done=previous.get("bytes_done"))
+            if previous.get("fragment_index"):
+                print(f"Resuming from fragment {previous['fragment_index']}/{previous.get('fragment_count', '?')}")
+
+            url = f"{self.iframe_origin}/{self.guid}/{resolution}/video.drm?contextId={self.context_id}"
             print(f"Download URL: {url}")
+            if disk and self.estimated_size():
+                disk.reserve(self, self.estimated_size(), peak=not self.average_bandwidth)
+            self._check_cancelled()
 
-            ydl_opts = {
-                "http_headers": {
-                    "Referer": self.embed_url,
-                    "User-Agent": self.user_agent["user-agent"],
-                },
-                "concurrent_fragment_downloads": 10,
-                "nocheckcertificate": True,
-                "outtmpl": self.file_name,
-                "restrictfilenames": True,
-                "windowsfilenames": True,
-                "nopart": True,
-                "paths": {
-                    "home": self.path,
-                    "temp": f".{self.file_name}",
-                },
-                "retries": 5,
-                "extractor_retries": 5,
-                "fragment_retries": 10,
-                "skip_unavailable_fragments": False,
-                "no_warnings": True,
-            }
-
-            print(f"Starting download: {self.file_name}")
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                ydl.download([url])
+            # Take fragment connections out of the shared budget, if any
+            if budget:
+                self.granted = budget.acquire(concurrent_fragments)
+            else:
+                self.granted = concurrent_fragments
+
+            print(f"Starting download: {self.file_name} ({self.granted} connections, {backend.name})")
+            with metrics.span("download", guid=self.guid, engine=backend.name, resolution=resolution):
+                backend.download(self, url, self.granted, show_progress=show_progress, resume=resume, previous=previous)
+            with metrics.span("verify", guid=self.guid):
+                self.verify()
+            metrics.count("videos", result="success")
+
+            if manifest:
+                manifest.update(self.guid, state="verified", file_path=self.output_file,
+                                size=os.path.getsize(self.output_file), checksum=self.checksum)
 
             print(f"Successfully downloaded: {self.file_name}")
             return True
 
         except Exception as e:
+            if self.cancelled is not None and self.cancelled.is_set():
+                print(f"Cancelled: {self.file_name}")
+                metrics.count("videos", result="cancelled")
+                self.error = "cancelled"
+                return False
             print(f"Error downloading video: {e}")
+            metrics.count("videos", result="failed")
+            self.error = str(e)
+            if manifest:
+                manifest.update(self.guid, error=str(e))
             return False
         finally:
-            self.session.close()
+            if budget and self.granted:
+                budget.release(self.granted)
+                self.granted = 0
+            if disk:
+                disk.release(self)
+            if policy:
+                policy.settle(self.estimated_bytes, self.downloaded_bytes)
+            if self.owns_session:
+                self.session.close()
+
+    def estimated_size(self):
+        """Return the expected size of the output file in bytes from the playlist, or None.
+
+        Uses the rendition's AVERAGE-BANDWIDTH if declared, otherwise its
+        peak BANDWIDTH, which can be several times the real size.
+        """
+        if self.average_bandwidth and self.declared_duration:
+            return int(self.average_bandwidth / 8 * self.declared_duration)
+        if self.estimated_bytes:
+            return int(self.estimated_bytes)
+        if self.bandwidth and self.declared_duration:
+            return int(self.bandwidth / 8 * self.declared_duration)
+        return None
+
+    def verify(self):
+        """Check the finished file and record the result in its sidecar.
+
+        Raises if the file is missing or doesn't match the playlist. The
+        checksum comes from the backend's StreamVerifier when it has one;
+        yt-dlp downloads only get the size and duration checks.
+        """
+        if not os.path.isfile(self.output_file) or os.path.getsize(self.output_file) == 0:
+            self._set_aside()
+            raise Exception(f"Verification failed: {self.output_file} is missing or empty")
+        size = os.path.getsize(self.output_file)
+        problems = self.stream.problems() if self.stream else []
+        if self.stream and not self.stream.remuxed and size != self.stream.bytes:
+            problems.append(f"{size} bytes on disk, {self.stream.bytes} written")
+
+        duration = probe_duration(self.output_file)
+        if duration is not None and self.declared_duration:
+            if abs(duration - self.declared_duration) > max(2.0, self.declared_duration * 0.02):
+                problems.append(f"plays for {duration:.1f}s, playlist declares {self.declared_duration:.1f}s")
+
+        # BANDWIDTH is a peak, and slides or a talking head can average well under a quarter of it, so a
+        # small file only fails when nothing else (ffprobe or the segment count) confirmed its length
+        if self.declared_duration and self.bandwidth:
+            minimum = self.declared_duration * self.bandwidth / 8 / 4
+            if size < minimum:
+                message = f"only {size / 1048576:.1f} MB for {self.declared_duration:.0f}s of video"
+                if duration is not None or self.stream:
+                    print(f"Warning: {message}, well under the declared bitrate")
+                else:
+                    problems.append(message)
+
+        if problems:
+            self._set_aside()
+            raise Exception(f"Verification failed: {'; '.join(problems)}")
+
+        self.checksum = f"sha256:{self.stream.hash.hexdigest()}" if self.stream else None
+        return write_sidecar(self.output_file, {
+            "guid": self.guid,
+            "embed_url": self.embed_url,
+            "resolution": self.resolution,
+            "checksum": self.checksum,
+            # A remuxed file differs from the downloaded stream the checksum was taken over
+            "checksum_of": ("stream" if self.stream.remuxed else "file") if self.stream else None,
+            "declared_duration": self.declared_duration,
+            "duration": duration,
+            "segments": self.stream.segments if self.stream else None,
+        })
+
+    def _set_aside(self):
+        """Move a file that failed verification back to .part, so it can't be taken for a finished one"""
+        part_file = f"{self.output_file}.part"
+        if os.path.isfile(self.output_file):
+            os.replace(self.output_file, part_file)
+            print(f"Moved the failed download back to {part_file}")
+        if self.manifest:
+            # Its fragments can't be trusted, so a resume starts over
+            self.manifest.update(self.guid, state="prepared", file_path=None,
+                                 fragment_index=None, fragment_count=None, bytes_done=None)
+
+    def _post_hook(self, filepath):
+        """Remember where yt-dlp put the finished file"""
+        self.output_file = filepath
+        if self.manifest:
+            self.manifest.update(self.guid, state="muxed", file_path=filepath)
+
+    def use_connections(self, count):
+        """Called by a backend that will use fewer connections than granted: frees the rest for other downloads"""
+        if self.budget and count < self.granted:
+            self.budget.release(self.granted - count)
+            self.granted = count
+        return self.granted
+
+    def throttle(self, nbytes):
+        """Wait until the bandwidth limits allow another nbytes. Returns the seconds waited"""
+        return self.rate_limiter.throttle(nbytes, self.rate_group) if self.rate_limiter else 0.0
+
+    def _check_cancelled(self):
+        if self.cancelled is not None and self.cancelled.is_set():
+            raise DownloadCancelled(f"{self.file_name} was cancelled")
+
+    def _progress_hook(self, status):
+        """Keep track of how many bytes and fragments yt-dlp has written"""
+        # Raising here is the only way to stop yt-dlp part way through
+        self._check_cancelled()
+        downloaded = status.get("downloaded_bytes")
+        if downloaded:
+            self.downloaded_bytes = downloaded
+        if self.manifest and status.get("status") == "downloading" and status.get("fragment_index"):
+            self.manifest.update(
+                self.guid, state="downloading",
+                fragment_index=status["fragment_index"],
+                fragment_count=status.get("fragment_count"),
+                bytes_done=status.get("file_offset"),
+                save=False
+            )
+
+def retry_delay(attempt, base=0.5, cap=30.0):
+    """Exponential backoff with full jitter"""
+    return random() * min(cap, base * 2 ** attempt)
+
+class HostConcurrency:
+    """AIMD concurrency limit for requests to one host.
+
+    The limit grows by one each interval while throughput keeps rising, is
+    cut by a quarter when latency climbs well above the best seen, and is
+    halved (at most once per interval) on 429/5xx responses or errors.
+    """
+
+    def __init__(self, host, initial=10, minimum=1, maximum=32, interval=2.0):
+        self.host = host
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.limit = float(min(max(initial, minimum), self.maximum))
+        self.peak = int(self.limit)
+        self.interval = interval
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+        self.window_start = time.time()
+        self.window_bytes = 0
+        self.window_latency = 0.0
+        self.window_requests = 0
+        self.last_throughput = 0.0
+        self.best_latency = None
+        self.last_decrease = 0.0
+
+    @property
+    def current(self):
+        return int(self.limit)
+
+    def acquire(self):
+        """Block until another request to this host is allowed"""
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def record(self, nbytes, latency=None):
+        """Record a successful transfer"""
+        with self.condition:
+            self.window_bytes += nbytes
+            if latency is not None:
+                self.window_latency += latency
+                self.window_requests += 1
+            self._adjust()
+
+    def record_error(self, status=None):
+        """Record a failed request; back off on throttling, server errors and network errors"""
+        if status is not None and status != 429 and status < 500:
+            return
+        with self.condition:
+            self._decrease(0.5)
+
+    def _decrease(self, factor):
+        now = time.time()
+        if now - self.last_decrease < self.interval:
+            return
+        self.limit = max(self.minimum, self.limit * factor)
+        self.last_decrease = now
+        self.condition.notify_all()
+
+    def _adjust(self):
+        elapsed = time.time() - self.window_start
+        if elapsed < self.interval:
+            return
+
+        throughput = self.window_bytes / elapsed
+        latency = self.window_latency / self.window_requests if self.window_requests else None
+        if latency is not None:
+            # Let the baseline drift up slowly so one lucky request doesn't pin it forever
+            self.best_latency = latency if self.best_latency is None else min(latency, self.best_latency * 1.05)
+
+        if latency is not None and latency > self.best_latency * 2:
+            self._decrease(0.75)
+        elif throughput > self.last_throughput * 1.05:
+            self.limit = min(self.maximum, self.limit + 1)
+            self.peak = max(self.peak, int(self.limit))
+            self.condition.notify_all()
+
+        self.last_throughput = throughput
+        self.window_start = time.time()
+        self.window_bytes = 0
+        self.window_latency = 0.0
+        self.window_requests = 0
+
+class AdaptiveConcurrency:
+    """Keeps one AIMD controller per host, shared by every download in the run"""
+
+    def __init__(self, initial=10, maximum=32):
+        self.initial = initial
+        self.maximum = maximum
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def for_host(self, host):
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = HostConcurrency(host, initial=self.initial, maximum=self.maximum)
+            return self.hosts[host]
+
+    def summary(self):
+        """Return a one-line description of the current limit per host"""
+        with self.lock:
+            hosts = [f"{c.host} {c.current} (peak {c.peak})" for c in self.hosts.values()]
+        return "Concurrency per host: " + (", ".join(hosts) if hosts else "none")
+
+class UnsupportedPlaylist(Exception):
+    """Raised when the native engine can't handle a playlist and yt-dlp should take over"""
+
+class DownloadCancelled(Exception):
+    """Raised inside a download whose job has been cancelled"""
+
+class YtDlpBackend:
+    """Downloads a prepared video with yt-dlp"""
+
+    name = "yt-dlp"
+
+    def __init__(self, concurrency=None):
+        self.concurrency = concurrency or AdaptiveConcurrency()
+
+    def retry_sleep(self, n):
+        """Delay before yt-dlp's next retry; yt-dlp calls it as sleep_func(n=retries so far)"""
+        metrics.count("retries", engine=self.name)
+        return retry_delay(n)
+
+    def download(self, video, url, connections, show_progress=True, resume=False, previous=None):
+        # yt-dlp can't change its concurrency mid-download, so start at the host's current limit
+        controller = self.concurrency.for_host(urlparse(url).hostname)
+        connections = video.use_connections(max(1, min(connections, controller.current)))
+        print(f"Using {connections} connections for {controller.host}")
+
+        last_bytes = [0]
+        finished_at = [None]
+
+        def throughput_hook(status):
+            downloaded = status.get("downloaded_bytes") or 0
+            if downloaded > last_bytes[0]:
+                delta, last_bytes[0] = downloaded - last_bytes[0], downloaded
+                controller.record(delta)
+                metrics.count("bytes", delta, engine=self.name)
+                # yt-dlp's own ratelimit is fixed per download and counted per fragment
+                # connection, so shared limits are applied by holding up the thread that read the data
+                video.throttle(delta)
+            if status.get("status") == "finished":
+                finished_at[0] = time.time()
+
+        def mux_hook(filepath):
+            # Everything between the last fragment and the final file is merging and moving
+            if finished_at[0]:
+                metrics.record_span("mux", time.time() - finished_at[0], guid=video.guid, engine=self.name)
+
+        ydl_opts = {
+            "http_headers": {
+                "Referer": video.embed_url,
+                "User-Agent": video.user_agent["user-agent"],
+            },
+            "concurrent_fragment_downloads": connections,
+            "nocheckcertificate": True,
+            "outtmpl": video.file_name,
+            "restrictfilenames": True,
+            "windowsfilenames": True,
+            # Partial files keep their .part suffix so they are never mistaken for finished ones
+            "nopart": False,
+            "continuedl": resume,
+            "paths": {
+                "home": video.path,
+                # Relative to home: fragments stay on the output filesystem, so the finished file is renamed, not copied
+                "temp": f".{video.file_name}",
+            },
+            "retries": 5,
+            "extractor_retries": 5,
+            "fragment_retries": 10,
+            "retry_sleep_functions": {"http": self.retry_sleep, "fragment": self.retry_sleep},
+            "skip_unavailable_fragments": False,
+            "no_warnings": True,
+            "noprogress": not show_progress,
+            "progress_hooks": [video._progress_hook, throughput_hook],
+            "post_hooks": [mux_hook, video._post_hook],
+        }
+
+        try:
+            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                ydl.download([url])
+        except Exception as e:
+            # yt-dlp gives up on a video with "fragment N not found" once a fragment's retries run out
+            if not isinstance(e, DownloadCancelled) and "fragment" in str(e).lower():
+                metrics.count("fragment_failures", engine=self.name)
+            raise
+
+def parse_media_playlist(text, playlist_url):
+    """Parse an HLS media playlist into its init segment and list of segments"""
+    init_url = None
+    segments = []
+    key = None
+    sequence = 0
+    duration = None
+
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith("#EXT-X-MEDIA-SEQUENCE:"):
+            sequence = int(line.split(":", 1)[1])
+        elif line.startswith("#EXTINF:"):
+            duration = float(line.split(":", 1)[1].split(",")[0])
+        elif line.startswith("#EXT-X-KEY:"):
+            attributes = dict(re.findall(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)', line.split(":", 1)[1]))
+            attributes = {k: v.strip('"') for k, v in attributes.items()}
+            if attributes.get("METHOD", "NONE") == "NONE":
+                key = None
+            elif attributes["METHOD"] == "AES-128":
+                key = {"uri": urljoin(playlist_url, attributes["URI"]), "iv": attributes.get("IV")}
+            else:
+                raise UnsupportedPlaylist(f"Unsupported encryption method {attributes['METHOD']}")
+        elif line.startswith("#EXT-X-MAP:"):
+            map_uri = re.search(r'URI="([^"]+)"', line)
+            if map_uri:
+                init_url = urljoin(playlist_url, map_uri.group(1))
+        elif line.startswith("#EXT-X-BYTERANGE"):
+            raise UnsupportedPlaylist("Byte-range segments are not supported")
+        elif not line.startswith("#"):
+            segments.append({
+                "url": urljoin(playlist_url, line),
+                "duration": duration or 0.0,
+                "key": key,
+                "sequence": sequence,
+            })
+            sequence += 1
+            duration = None
+
+    if not segments:
+        raise UnsupportedPlaylist("No segments in media playlist")
+    return init_url, segments
+
+def _load_aes_decrypter():
+    """Return an AES-128-CBC decrypt function (key, iv, data), or None if no library is available"""
+    for module in ("Cryptodome.Cipher", "Crypto.Cipher"):
+        try:
+            AES = __import__(module, fromlist=["AES"]).AES
+            return lambda key, iv, data: AES.new(key, AES.MODE_CBC, iv).decrypt(data)
+        except ImportError:
+            continue
+    try:
+        from yt_dlp.aes import aes_cbc_decrypt_bytes
+        return lambda key, iv, data: aes_cbc_decrypt_bytes(data, key, iv)
+    except ImportError:
+        return None
+
+class NativeHlsBackend:
+    """Built-in HLS downloader that shares one connection pool across all videos.
+
+    Segments are fetched in parallel and written to the output file in
+    playlist order through a small reorder window. Playlists it can't
+    handle are passed on to yt-dlp.
+    """
+
+    name = "native"
+    sync_interval = 2.0  # Seconds between fsyncs that make the manifest's resume point safe
+
+    def __init__(self, pool_size=32, retries=10, concurrency=None, sessions=None, preallocate=True):
+        self.retries = retries
+        self.preallocate = preallocate and hasattr(os, "posix_fallocate")
+        self.concurrency = concurrency or AdaptiveConcurrency(maximum=pool_size)
+        # Segments reuse the connections the DRM requests already opened to the video server
+        self.owns_sessions = sessions is None
+        self.sessions = sessions or SessionPool(hosts=8, per_host=pool_size)
+        self.session = self.sessions.session()
+        self.decrypt = None  # Loaded with the first encrypted playlist
+        self.fallback = YtDlpBackend(self.concurrency)
+
+    def download(self, video, url, connections, show_progress=True, resume=False, previous=None):
+        headers = {"Referer": video.embed_url, "User-Agent": video.user_agent["user-agent"]}
+        try:
+            response = self.session.get(url, headers=headers, timeout=30)
+            response.raise_for_status()
+            init_url, segments = parse_media_playlist(response.text, url)
+            if self.decrypt is None and any(segment["key"] for segment in segments):
+                self.decrypt = _load_aes_decrypter()
+            if self.decrypt is None and any(segment["key"] for segment in segments):
+                raise UnsupportedPlaylist("Encrypted segments need pycryptodomex or yt-dlp")
+        except UnsupportedPlaylist as e:
+            print(f"Native engine can't handle this playlist ({e}), falling back to yt-dlp")
+            return self.fallback.download(video, url, connections, show_progress, resume, previous)
+
+        part_file = f"{video.output_file}.part"
+        start_index, offset = 0, 0
+        previous = previous or {}
+        if resume and previous.get("bytes_done") and os.path.isfile(part_file):
+            if os.path.getsize(part_file) >= previous["bytes_done"]:
+                start_index, offset = previous["fragment_index"], previous["bytes_done"]
+
+        keys = {}
+        stream = video.stream = StreamVerifier(segments)
+        with open(part_file, "r+b" if offset else "wb") as f:
+            f.truncate(offset)
+            if offset:
+                stream.resume(f, offset, segments[:start_index])
+            self._preallocate(f, offset, video.estimated_size())
+            f.seek(offset)
+            if init_url and not offset:
+                data = self._fetch(init_url, headers, video.throttle)
+                f.write(data)
+                stream.update(data)
+
+            self._fetch_segments(video, segments, start_index, connections, headers, keys, f, show_progress)
+            # Drop whatever was preallocated beyond the real end of the stream
+            f.truncate()
+
+        # Check the stream while it is still a .part file, so a short download never gets the final name
+        problems = stream.problems()
+        if problems:
+            if video.manifest:
+                video.manifest.update(video.guid, fragment_index=None, fragment_count=None, bytes_done=None)
+            raise Exception(f"Verification failed: {'; '.join(problems)}")
+
+        with metrics.span("mux", guid=video.guid, engine=self.name):
+            stream.remuxed = self._finish(part_file, video.output_file, is_mp4=bool(init_url))
+        video._post_hook(video.output_file)
+
+    def _preallocate(self, f, offset, size):
+        """Reserve the file's expected size on disk up front, so it is written in one contiguous piece"""
+        if not self.preallocate or not size or size <= offset:
+            return
+        try:
+            os.posix_fallocate(f.fileno(), offset, size - offset)
+        except OSError as e:
+            print(f"Can't preallocate {size / 1048576:.0f} MB ({e}), continuing without")
+            self.preallocate = False
+
+    def _fetch_segments(self, video, segments, start_index, connections, headers, keys, f, show_progress):
+        """Fetch segments in parallel and write them in order"""
+        total = len(segments)
+        window = max(1, connections) * 2  # Segments fetched ahead of the one being written
+        controller = self.concurrency.for_host(urlparse(segments[0]["url"]).hostname)
+        next_submit = start_index
+        futures = {}
+        last_report = 0.0
+        last_sync = time.time()
+
+        with ThreadPoolExecutor(max_workers=max(1, connections)) as executor:
+            for index in range(start_index, total):
+                while next_submit < total and next_submit - index < window:
+                    futures[next_submit] = executor.submit(
+                        self._fetch_segment, segments[next_submit], headers, keys, video.throttle
+                    )
+                    next_submit += 1
+
+                try:
+                    data = futures.pop(index).result()
+                except Exception:
+                    metrics.count("fragment_failures", engine=self.name)
+                    raise
+                f.write(data)
+                video.stream.update(data, segments[index])
+                metrics.count("bytes", len(data), engine=self.name)
+                video.downloaded_bytes += len(data)
+                status = {"status": "downloading", "downloaded_bytes": video.downloaded_bytes}
+                if time.time() - last_sync >= self.sync_interval or index + 1 == total:
+                    # A preallocated file is full size from the start, so its length proves nothing after
+                    # a crash: only offer a resume point once everything before it is on disk
+                    f.flush()
+                    os.fsync(f.fileno())
+                    last_sync = time.time()
+                    status.update(fragment_index=index + 1, fragment_count=total, file_offset=f.tell())
+                video._progress_hook(status)
+
+                if show_progress and time.time() - last_report >= 2:
+                    last_report = time.time()
+                    print(f"{video.file_name}: {index + 1}/{total} fragments, "
+                          f"{video.downloaded_bytes / 1048576:.1f} MB, {controller.host} x{controller.current}"
+                          + (f", {video.rate_limiter.describe(video.rate_group)}" if video.rate_limiter else ""))
+
+    def _fetch_segment(self, segment, headers, keys, throttle=None):
+        data = self._fetch(segment["url"], headers, throttle)
+        key = segment["key"]
+        if not key:
+            return data
+
+        if key["uri"] not in keys:
+            keys[key["uri"]] = self._fetch(key["uri"], headers)
+        if key["iv"]:
+            iv = bytes.fromhex(key["iv"][2:] if key["iv"].lower().startswith("0x") else key["iv"])
+        else:
+            iv = segment["sequence"].to_bytes(16, "big")
+        data = self.decrypt(keys[key["uri"]], iv, data)
+        # Strip PKCS#7 padding
+        padding = data[-1] if data else 0
+        if 0 < padding <= 16 and data[-padding:] == bytes([padding]) * padding:
+            return data[:-padding]
+        return data
+
+    def _fetch(self, url, headers, throttle=None):
+        """GET a URL with jittered retries, under the host's adaptive concurrency limit.
+
+        The body is read in chunks passed to throttle(nbytes), which may
+        sleep to keep within the bandwidth limits.
+        """
+        controller = self.concurrency.for_host(urlparse(url).hostname)
+        for attempt in range(self.retries + 1):
+            delay = retry_delay(attempt)
+            controller.acquire()
+            try:
+                start = time.time()
+                waited = 0.0
+                with self.session.get(url, headers=headers, timeout=30, stream=True) as response:
+                    if response.status_code == 429 or response.status_code >= 500:
+                        controller.record_error(response.status_code)
+                        retry_after = response.headers.get("retry-after", "")
+                        if retry_after.isdigit():
+                            delay = max(delay, int(retry_after))
+                    response.raise_for_status()
+                    chunks = []
+                    for chunk in response.iter_content(65536):
+                        chunks.append(chunk)
+                        if throttle:
+                            waited += throttle(len(chunk))
+                    data = b"".join(chunks)
+                expected = response.headers.get("content-length")
+                if expected and "content-encoding" not in response.headers and int(expected) != len(data):
+                    raise Exception(f"Short read: got {len(data)} of {expected} bytes")
+                # Time spent held back by the rate limit says nothing about the host
+                controller.record(len(data), time.time() - start - waited)
+                return data
+            except requests.exceptions.RequestException as e:
+                if not isinstance(e, requests.exceptions.HTTPError):
+                    controller.record_error()
+                error = e
+            except Exception as e:
+                error = e
+            finally:
+                controller.release()
+
+            if attempt == self.retries:
+                raise error
+            metrics.count("retries", engine=self.name)
+            print(f"Retrying {url} in {delay:.1f}s after error: {error}")
+            time.sleep(delay)
+
+    def _finish(self, part_file, output_file, is_mp4):
+        """Move the finished download into place, remuxing MPEG-TS to MP4 when ffmpeg is available.
+
+        Returns True if the file was remuxed.
+        """
+        ffmpeg = shutil.which("ffmpeg")
+        if is_mp4 or not ffmpeg:
+            if not is_mp4:
+                print("ffmpeg not found, keeping the MPEG-TS stream as is")
+            os.replace(part_file, output_file)
+            return False
+
+        subprocess.run(
+            [ffmpeg, "-y", "-loglevel", "error", "-i", part_file, "-c", "copy", "-f", "mp4", output_file],
+            check=True
+        )
+        os.remove(part_file)
+        return True
+
+    def close(self):
+        if self.owns_sessions:
+            self.sessions.close()
+
+class ConnectionBudget:
+    """Caps the number of fragment connections in flight across all downloads"""
+
+    def __init__(self, limit):
+        self.limit = max(1, limit)
+        self.available = self.limit
+        self.condition = threading.Condition()
+
+    def acquire(self, wanted):
+        """Block until a slot is free, then take up to `wanted` slots"""
+        with self.condition:
+            while self.available < 1:
+                self.condition.wait()
+            granted = min(max(1, wanted), self.available)
+            self.available -= granted
+            return granted
+
+    def release(self, count):
+        """Return slots to the budget"""
+        with self.condition:
+            self.available = min(self.limit, self.available + count)
+            self.condition.notify_all()
+
+class TokenBucket:
+    """Limits the bytes read by any number of threads to `rate` bytes per second.
+
+    consume() takes the bytes straight away and then sleeps off the debt,
+    so a chunk larger than the burst still goes through and concurrent
+    readers line up behind each other. The rate can be changed while
+    downloads are running; None means no limit, but the bytes are still
+    counted for the achieved rate.
+    """
+
+    def __init__(self, rate=None):
+        self.lock = threading.Lock()
+        self.rate = None
+        self.burst = 0
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.total = 0
+        self.started = None
+        self.last = None
+        self.samples = deque(maxlen=10)  # (time, total bytes) half a second apart, for the achieved rate
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.rate = rate or None
+            # A quarter second of burst evens out chunk sizes without letting a new download spike
+            self.burst = max(262144, rate / 4) if rate else 0
+            self.tokens = min(self.tokens, self.burst)
+
+    def consume(self, nbytes):
+        """Take nbytes from the bucket, sleeping until the rate allows them. Returns the seconds slept"""
+        with self.lock:
+            now = time.monotonic()
+            self.started = self.started or now
+            self.last = now
+            self.total += nbytes
+            if not self.samples or now - self.samples[-1][0] >= 0.5:
+                self.samples.append((now, self.total))
+            if not self.rate:
+                return 0.0
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate) - nbytes
+            self.updated = now
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def achieved(self):
+        """Return the bytes per second that went through over the last five seconds"""
+        with self.lock:
+            now = time.monotonic()
+            recent = [sample for sample in self.samples if now - sample[0] <= 5.0]
+            if not recent or now - recent[0][0] < 0.5:
+                return 0.0
+            return (self.total - recent[0][1]) / (now - recent[0][0])
+
+    def average(self):
+        """Return the bytes per second between the first and the last chunk"""
+        with self.lock:
+            elapsed = (self.last - self.started) if self.started else 0.0
+            return self.total / elapsed if elapsed > 0 else 0.0
+
+class RateLimiter:
+    """Global and per-job bandwidth limits for everything downloaded in a run.
+
+    Every chunk of a segment is taken from its job's bucket, when there is a
+    per-job rate, and then from the global one. The global rate can follow
+    the time of day: schedule is a list of (start, end, rate) windows in
+    minutes after midnight, and the plain rate applies outside them. Jobs
+    are service jobs, or the output directories of a batch.
+    """
+
+    def __init__(self, rate=None, job_rate=None, schedule=None):
+        self.rate = rate or None
+        self.job_rate = job_rate or None
+        self.schedule = schedule or []
+        self.bucket = TokenBucket(self.allowed())
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.checked = time.monotonic()
+
+    @classmethod
+    def parse(cls, rate=None, job_rate=None, schedule=None):
+        """Build the limits from --max-rate, --job-rate and --rate-schedule values.
+
+        Rates are sizes per second, like "5M". The schedule is a comma
+        separated list of windows like "09:00-18:00=2M"; a window may wrap
+        past midnight, and a rate of 0 lifts the limit while it lasts.
+        """
+        windows = []
+        for part in filter(None, (p.strip() for p in (schedule or "").split(","))):
+            match = re.fullmatch(r"(\d{1,2}):(\d\d)\s*-\s*(\d{1,2}):(\d\d)\s*=\s*(.+)", part)
+            times = [(int(match.group(i)), int(match.group(i + 1))) for i in (1, 3)] if match else []
+            # Hours 0-23 and minutes 0-59, with 24:00 for the end of the day
+            if not match or any(hour > 24 or minute > 59 or (hour == 24 and minute) for hour, minute in times):
+                raise ValueError(f"Invalid rate schedule window: {part}")
+            (start_hour, start_minute), (end_hour, end_minute) = times
+            start = start_hour * 60 + start_minute
+            end = end_hour * 60 + end_minute
+            windows.append((start, end, parse_size(match.group(5))))
+        return cls(parse_size(rate) if rate else None, parse_size(job_rate) if job_rate else None, windows)
+
+    def allowed(self, job=None):
+        """Return the rate allowed right now in bytes per second, for one job if given, or None"""
+        now = time.localtime()
+        minute = now.tm_hour * 60 + now.tm_min
+        rate = self.rate
+        for start, end, window_rate in self.schedule:
+            if (start <= minute < end) if start <= end else (minute >= start or minute < end):
+                rate = window_rate or None
+                break
+        if job is not None and self.job_rate:
+            rate = min(rate, self.job_rate) if rate else self.job_rate
+        return rate
+
+    def throttle(self, nbytes, job=None):
+        """Wait until the job's and the global limits allow another nbytes. Returns the seconds waited"""
+        if self.schedule and time.monotonic() - self.checked >= 10:
+            self._follow_schedule()
+        waited = 0.0
+        if job is not None and self.job_rate:
+            with self.lock:
+                bucket = self.jobs.get(job) or self.jobs.setdefault(job, TokenBucket(self.job_rate))
+            waited += bucket.consume(nbytes)
+        return waited + self.bucket.consume(nbytes)
+
+    def achieved(self, job=None):
+        """Return the bytes per second downloaded lately, overall or by one job with its own limit"""
+        bucket = self.jobs.get(job) if job is not None else self.bucket
+        return bucket.achieved() if bucket else 0.0
+
+    def describe(self, job=None):
+        """Return the achieved and allowed rate for a progress line"""
+        line = f"{self.bucket.achieved() / 1048576:.1f} MB/s of {format_rate(self.bucket.rate)}"
+        if job is not None and job in self.jobs:
+            line = f"job {self.achieved(job) / 1048576:.1f} MB/s of {format_rate(self.job_rate)}, total {line}"
+        return line
+
+    def summary(self):
+        """Return a one-line description of the limits and the rate achieved"""
+        limits = [f"{format_rate(self.rate)} allowed"]
+        if self.schedule:
+            limits.append(f"{len(self.schedule)} scheduled windows")
+        if self.job_rate:
+            limits.append(f"{format_rate(self.job_rate)} per job")
+        return (f"Bandwidth: {self.bucket.total / 1048576:.1f} MB at {self.bucket.average() / 1048576:.2f} MB/s "
+                f"({', '.join(limits)})")
+
+    def _follow_schedule(self):
+        with self.lock:
+            self.checked = time.monotonic()
+            rate = self.allowed()
+            if rate == self.bucket.rate:
+                return
+            self.bucket.set_rate(rate)
+        print(f"Bandwidth limit is now {format_rate(rate)}")
+
+class DiskSpace:
+    """Keeps the downloads of a run from filling up the output disk.
+
+    Each download reserves its estimated size before it starts and fails
+    early if that doesn't fit next to what running downloads still have to
+    write. The first estimate is also multiplied out over the videos still
+    to come, with a warning if the whole batch is unlikely to fit.
+    """
+
+    def __init__(self, path, margin=256 * 1048576):
+        self.path = path or "."
+        self.margin = margin
+        self.pending = 0
+        self.reserved = {}  # guid -> (estimated bytes, video)
+        self.warned = False
+        self.lock = threading.Lock()
+
+    def free(self):
+        return shutil.disk_usage(self.path).free
+
+    def add_videos(self, count):
+        """Tell the check how many more videos the batch holds"""
+        with self.lock:
+            self.pending = max(0, self.pending + count)
+
+    def reserve(self, video, estimate, peak=False):
+        """Reserve room for a video, raising if there isn't enough.
+
+        An estimate from the peak bitrate (peak=True) can be four times the
+        real size or more, so it only fails below a quarter of the estimate
+        and warns otherwise.
+        """
+        with self.lock:
+            self.pending = max(0, self.pending - 1)
+            # Running downloads have already taken part of their reservation out of the free space
+            outstanding = sum(max(0, size - v.downloaded_bytes) for size, v in self.reserved.values())
+            available = self.free() - outstanding - self.margin
+            required = estimate / 4 if peak else estimate
+            if required > available:
+                raise Exception(f"Not enough disk space: at least {required / 1073741824:.2f} GB needed, "
+                                f"{max(0, available) / 1073741824:.2f} GB free in {self.path}")
+            if estimate > available:
+                print(f"Warning: {video.file_name} may need up to {estimate / 1073741824:.2f} GB at its peak "
+                      f"bitrate, {available / 1073741824:.2f} GB is free in {self.path}")
+            self.reserved[video.guid] = (int(required), video)
+
+            needed = estimate * (self.pending + 1)
+            if not self.warned and self.pending and needed > available:
+                self.warned = True
+                print(f"Warning: the remaining {self.pending + 1} videos need about {needed / 1073741824:.1f} GB, "
+                      f"but only {available / 1073741824:.1f} GB is free in {self.path}")
+
+    def release(self, video):
+        with self.lock:
+            self.reserved.pop(video.guid, None)
+
+    def summary(self):
+        return f"Free disk space: {self.free() / 1073741824:.1f} GB in {self.path}"
+
+class StageStats:
+    """Throughput counters for one pipeline stage"""
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.items = 0
+        self.failed = 0
+        self.bytes = 0
+        self.busy = 0.0      # Seconds spent working, summed over threads
+        self.blocked = 0.0   # Seconds spent waiting on the queue
+        self.started = None
+        self.finished = None
+
+    def record(self, seconds, ok=True, nbytes=0):
+        """Record one processed item"""
+        with self.lock:
+            now = time.time()
+            if self.started is None:
+                self.started = now - seconds
+            self.finished = now
+            self.busy += seconds
+            self.bytes += nbytes
+            if ok:
+                self.items += 1
+            else:
+                self.failed += 1
+
+    def record_blocked(self, seconds):
+        """Record time spent waiting for the other stage"""
+        with self.lock:
+            self.blocked += seconds
+
+    def summary(self):
+        """Return a one-line description of the stage's throughput"""
+        wall = (self.finished - self.started) if self.started is not None else 0.0
+        total = self.items + self.failed
+        rate = total / wall * 60 if wall > 0 else 0.0
+        line = (f"{self.name}: {total} items ({self.failed} failed) in {wall:.1f}s, "
+                f"{rate:.1f} items/min, busy {self.busy:.1f}s, waiting {self.blocked:.1f}s")
+        if self.bytes:
+            line += f", {self.bytes / 1048576:.1f} MB ({self.bytes / 1048576 / wall if wall > 0 else 0:.2f} MB/s)"
+        return line
+
+class MonitoredQueue(queue.Queue):
+    """Bounded queue that samples its depth on every put and get"""
+
+    def __init__(self, maxsize=0):
+        super().__init__(maxsize)
+        self.depth_samples = 0
+        self.depth_total = 0
+        self.max_depth = 0
+
+    def _sample(self):
+        depth = self._qsize()
+        self.depth_samples += 1
+        self.depth_total += depth
+        self.max_depth = max(self.max_depth, depth)
+
+    def _put(self, item):
+        super()._put(item)
+        self._sample()
+
+    def _get(self):
+        item = super()._get()
+        self._sample()
+        return item
+
+    def summary(self):
+        """Return a one-line description of the queue depth"""
+        average = self.depth_total / self.depth_samples if self.depth_samples else 0.0
+        limit = self.maxsize if self.maxsize > 0 else "unbounded"
+        return f"Queue depth: avg {average:.1f}, max {self.max_depth} (limit {limit})"
+
+class FairQueue(MonitoredQueue):
+    """Queue that shares download slots between jobs instead of serving them in arrival order.
+
+    Items are grouped by key(item), the job or batch entry they came from.
+    "round-robin" takes one item from each group in turn; "smallest-first"
+    takes from the group with the fewest items left, so short jobs finish
+    early instead of waiting behind long ones. None, the workers' stop
+    signal, only comes out once everything else has.
+    """
+
+    policies = ("fifo", "round-robin", "smallest-first")
+
+    def __init__(self, maxsize=0, policy="round-robin", key=None):
+        self.policy = policy
+        self.key = key or (lambda item: None)
+        super().__init__(maxsize)
+
+    def _init(self, maxsize):
+        self.groups = {}  # key -> deque of items, in the order the groups take turns
+        self.stops = 0
+
+    def _qsize(self):
+        return sum(len(items) for items in self.groups.values()) + self.stops
+
+    def _put(self, item):
+        if item is None:
+            self.stops += 1
+        else:
+            self.groups.setdefault(self.key(item), deque()).append(item)
+        self._sample()
+
+    def _get(self):
+        if self.groups:
+            if self.policy == "smallest-first":
+                key = min(self.groups, key=lambda k: len(self.groups[k]))
+            else:
+                key = next(iter(self.groups))
+            items = self.groups.pop(key)
+            item = items.popleft()
+            if items:
+                # Back of the line until the other groups have had their turn
+                self.groups[key] = items
+        else:
+            self.stops -= 1
+            item = None
+        self._sample()
+        return item
+
+class ResolutionCache:
+    """On-disk SQLite cache of index links, page -> embed mappings and finished videos"""
+
+    links_ttl = 24 * 3600        # Course indexes change when lessons are added
+    embeds_ttl = 7 * 24 * 3600   # Lesson pages rarely swap their video
+
+    def __init__(self, path, refresh=False):
+        self.path = path
+        self.refresh = refresh
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.executescript("""
+                CREATE TABLE IF NOT EXISTS index_links (
+                    index_url TEXT, base_url TEXT, crawl_depth INTEGER, follow TEXT, links TEXT, fetched_at REAL,
+                    PRIMARY KEY (index_url, base_url, crawl_depth, follow)
+                );
+                CREATE TABLE IF NOT EXISTS pages (
+                    page_url TEXT PRIMARY KEY, embed_url TEXT, guid TEXT, resolved_at REAL
+                );
+                CREATE TABLE IF NOT EXISTS videos (
+                    guid TEXT PRIMARY KEY, embed_url TEXT, resolution TEXT,
+                    file_path TEXT, size INTEGER, checksum TEXT, completed_at REAL
+                );
+            """)
+
+    def _fresh(self, timestamp, ttl):
+        return not self.refresh and timestamp is not None and time.time() - timestamp < ttl
+
+    def get_links(self, index_url, base_url, crawl_depth=0, follow=None):
+        """Return the cached links of an index page crawled with the same options, or None if missing or stale"""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT links, fetched_at FROM index_links "
+                "WHERE index_url = ? AND base_url = ? AND crawl_depth = ? AND follow = ?",
+                (index_url, base_url, crawl_depth, follow or "")
+            ).fetchone()
+        if row and self._fresh(row[1], self.links_ttl):
+            return json.loads(row[0])
+        return None
+
+    def put_links(self, index_url, base_url, links, crawl_depth=0, follow=None):
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO index_links VALUES (?, ?, ?, ?, ?, ?)",
+                (index_url, base_url, crawl_depth, follow or "", json.dumps(links), time.time())
+            )
+
+    def get_embed(self, page_url):
+        """Return the cached embed URL of a lesson page, or None if missing or stale"""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT embed_url, resolved_at FROM pages WHERE page_url = ?", (page_url,)
+            ).fetchone()
+        if row and self._fresh(row[1], self.embeds_ttl):
+            return row[0]
+        return None
+
+    def put_embed(self, page_url, embed_url):
+        guid = urlparse(embed_url).path.split("/")[-1]
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?)",
+                (page_url, embed_url, guid, time.time())
+            )
+
+    def completed_file(self, embed_url):
+        """Return the output file of a finished video if it's still on disk at its recorded size"""
+        guid = urlparse(embed_url).path.split("/")[-1]
+        with self.lock:
+            row = self.db.execute("SELECT file_path, size FROM videos WHERE guid = ?", (guid,)).fetchone()
+        if row and verified_file(row[0], row[1]):
+            return row[0]
+        return None
+
+    def put_video(self, embed_url, resolution, file_path, checksum=None):
+        guid = urlparse(embed_url).path.split("/")[-1]
+        size = os.path.getsize(file_path) if os.path.isfile(file_path) else None
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO videos VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (guid, embed_url, resolution, file_path, size, checksum, time.time())
+            )
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+class JobManifest:
+    """Per-video job state, kept as JSON in the output directory.
+
+    A video moves through discovered -> prepared -> downloading -> muxed ->
+    verified. The manifest is rewritten atomically, so an interrupted run
+    leaves behind an accurate record for --resume.
+    """
+
+    states = ("discovered", "prepared", "downloading", "muxed", "verified")
+    save_interval = 1.0  # Seconds between saves for fragment progress
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.last_save = 0.0
+        self.jobs = {}
+        if os.path.isfile(path):
+            try:
+                with open(path) as f:
+                    self.jobs = json.load(f)
+            except (ValueError, OSError) as e:
+                print(f"Ignoring unreadable job manifest {path}: {e}")
+
+    def get(self, guid):
+        with self.lock:
+            return dict(self.jobs.get(guid, {}))
+
+    def update(self, guid, save=True, **fields):
+        """Update a job's fields; fragment progress passes save=False and is saved periodically"""
+        with self.lock:
+            job = self.jobs.setdefault(guid, {})
+            job.update(fields)
+            job["updated_at"] = time.time()
+            if save or time.time() - self.last_save >= self.save_interval:
+                self._save()
+
+    def unfinished(self):
+        """Return the jobs that never reached the verified state"""
+        with self.lock:
+            return {guid: dict(job) for guid, job in self.jobs.items() if job.get("state") != "verified"}
+
+    def completed_file(self, embed_url):
+        """Return the output file of a verified job if it's still on disk, unchanged"""
+        job = self.get(urlparse(embed_url).path.split("/")[-1])
+        if job.get("state") == "verified" and verified_file(job.get("file_path"), job.get("size")):
+            return job["file_path"]
+        return None
+
+    def save(self):
+        with self.lock:
+            self._save()
+
+    def _save(self):
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.jobs, f, indent=1)
+        os.replace(temp_path, self.path)
+        self.last_save = time.time()
+
+class DownloadScheduler:
+    """Runs video downloads on a pool of worker threads fed by a bounded queue"""
+
+    report_interval = 10.0  # Seconds between the overall rate and concurrency lines
+
+    def __init__(self, jobs=1, max_connections=32, concurrent_fragments=10, output_path="", queue_size=0,
+                 cache=None, manifest=None, resume=False, engine="yt-dlp", policy=None, sessions=None,
+                 preallocate=True, rate_limiter=None, schedule="fifo"):
+        self.jobs = max(1, jobs)
+        self.policy = policy
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.sessions = sessions
+        self.disk = DiskSpace(output_path)
+        self.concurrency = AdaptiveConcurrency(initial=concurrent_fragments, maximum=max_connections)
+        if engine == "native":
+            self.backend = NativeHlsBackend(pool_size=max_connections, concurrency=self.concurrency, sessions=sessions,
+                                            preallocate=preallocate)
+        else:
+            self.backend = YtDlpBackend(self.concurrency)
+        self.cache = cache
+        self.manifest = manifest
+        self.resume = resume
+        self.submitted = set()
+        self.budget = ConnectionBudget(max_connections)
+        self.concurrent_fragments = concurrent_fragments
+        self.output_path = output_path
+        if schedule == "fifo":
+            self.queue = MonitoredQueue(queue_size if queue_size > 0 else self.jobs)
+        else:
+            # Unbounded by default, so there are videos from several jobs to choose between
+            self.queue = FairQueue(queue_size, schedule, key=lambda item: self._group(item[3], item[4]))
+        self.stats = StageStats("Download")
+        self.lock = threading.Lock()
+        self.workers = []
+        self.successful = 0
+        self.failed = 0
+        self.skipped = 0
+        self.duplicates = 0
+        self.cancelled = 0
+        self.running = 0
+        self.stopping = threading.Event()  # Set to abandon the run: stops downloads that have no job of their own
+        self.closed = threading.Event()
+        self.reporter = None
+
+    def start(self):
+        """Start the worker threads"""
+        for n in range(self.jobs):
+            worker = threading.Thread(target=self._worker, name=f"download-{n + 1}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+        if self.reporter is None:
+            self.closed.clear()
+            self.reporter = threading.Thread(target=self._report_loop, name="download-report", daemon=True)
+            self.reporter.start()
+
+    def submit(self, page_url, embed_url, name, path=None, job=None):
+        """Queue a video for download, blocking while the queue is full.
+
+        Videos already queued or downloaded in this run (by GUID) are
+        ignored, even if they were found on another page. job, if given, is
+        told how the video gets on. Returns the number of seconds spent
+        waiting for a free slot.
+        """
+        guid = urlparse(embed_url).path.split("/")[-1]
+        path = path or self.output_path
+        if job and job.cancelled.is_set():
+            self.add_videos(-1)
+            return 0.0
+        with self.lock:
+            duplicate = guid in self.submitted
+            if duplicate:
+                self.duplicates += 1
+            self.submitted.add(guid)
+        if duplicate:
+            print(f"Skipping {page_url} - video {guid} is already queued")
+            self.add_videos(-1)
+            if job:
+                job.add_video(guid, name, state="duplicate")
+            return 0.0
+        if self.manifest and self.manifest.get(guid).get("state") is None:
+            self.manifest.update(guid, state="discovered", page_url=page_url, embed_url=embed_url, name=name, path=path)
+        if job:
+            job.add_video(guid, name)
+
+        start = time.time()
+        self.queue.put((page_url, embed_url, name, path, job))
+        return time.time() - start
+
+    def add_videos(self, count):
+        """Tell the quality policy and the disk space check how many more videos to expect"""
+        if self.policy:
+            self.policy.add_videos(count)
+        self.disk.add_videos(count)
+
+    def record_failure(self, page_url=None, job=None):
+        """Count a video that failed before reaching the scheduler"""
+        with self.lock:
+            self.failed += 1
+        self.add_videos(-1)
+        if job:
+            job.add_video(page_url, "", state="failed", error="No embed URL found")
+
+    def record_skip(self, embed_url=None, job=None):
+        """Count a video that is already downloaded"""
+        metrics.count("videos", result="skipped")
+        with self.lock:
+            self.skipped += 1
+        self.add_videos(-1)
+        if job:
+            job.add_video(urlparse(embed_url).path.split("/")[-1], "", state="skipped")
+
+    def close(self, cancel=False):
+        """Wait for all queued downloads to finish and stop the workers.
+
+        With cancel=True (on Ctrl-C or an error), queued videos are dropped
+        and running downloads are stopped instead; their manifest entries
+        and .part files are kept for --resume.
+        """
+        if cancel and self.workers:
+            self.stopping.set()
+            dropped = 0
+            while True:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    continue
+                dropped += 1
+                page_url, embed_url, name, path, job = item
+                if job:
+                    job.finish_video(urlparse(embed_url).path.split("/")[-1], "cancelled")
+            with self.lock:
+                self.cancelled += dropped
+            print(f"Stopping: {dropped} queued videos dropped, waiting for running downloads to stop")
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+        self.closed.set()
+        if self.reporter:
+            self.reporter.join()
+            self.reporter = None
+        if hasattr(self.backend, "close"):
+            self.backend.close()
+
+    def _worker(self):
+        while True:
+            waiting = time.time()
+            item = self.queue.get()
+            self.stats.record_blocked(time.time() - waiting)
+            if item is None:
+                break
+
+            page_url, embed_url, name, path, job = item
+            guid = urlparse(embed_url).path.split("/")[-1]
+            start = time.time()
+            if (job.cancelled if job else self.stopping).is_set():
+                ok, nbytes, error = False, 0, "cancelled"
+            else:
+                with self.lock:
+                    self.running += 1
+                try:
+                    ok, nbytes, error = self._run(page_url, embed_url, name, path, job)
+                finally:
+                    with self.lock:
+                        self.running -= 1
+
+            cancelled = not ok and (job.cancelled if job else self.stopping).is_set()
+            if not cancelled:
+                self.stats.record(time.time() - start, ok=ok, nbytes=nbytes)
+            with self.lock:
+                if ok:
+                    self.successful += 1
+                elif cancelled:
+                    self.cancelled += 1
+                else:
+                    self.failed += 1
+                if not ok:
+                    # Let a later submission try again
+                    self.submitted.discard(guid)
+            if job:
+                job.finish_video(guid, "done" if ok else "cancelled" if cancelled else "failed", error)
+
+    def _report_loop(self):
+        """Print the overall rate and the concurrency per host while downloads run.
+
+        Per-video progress lines are off with more than one worker, so this
+        is where the rate limits and the concurrency show up.
+        """
+        while not self.closed.wait(self.report_interval):
+            with self.lock:
+                running, queued = self.running, self.queue.qsize()
+            if running:
+                print(f"{running} downloads running, {queued} queued: {self.rate_limiter.describe()}. "
+                      f"{self.concurrency.summary()}")
+
+    def _group(self, path, job=None):
+        """Return what a video counts towards for fair scheduling and per-job limits"""
+        return job.id if job else path
+
+    def _run(self, page_url, embed_url, name, path, job=None):
+        """Download one video, returning (ok, bytes downloaded, error)"""
+        video = None
+        try:
+            if path:
+                os.makedirs(path, exist_ok=True)
+            video = BunnyVideoDRM(
+                referer=page_url,
+                embed_url=embed_url,
+                name=name,
+                path=path,
+                sessions=self.sessions,
+                cancelled=job.cancelled if job else self.stopping,
+                rate_limiter=self.rate_limiter,
+                rate_group=self._group(path, job)
+            )
+            if job:
+                job.start_video(video.guid, video)
+            ok = video.download(
+                budget=self.budget,
+                concurrent_fragments=self.concurrent_fragments,
+                show_progress=self.jobs == 1,
+                manifest=self.manifest,
+                resume=self.resume,
+                backend=self.backend,
+                policy=self.policy,
+                disk=self.disk
+            )
+            if ok and self.cache:
+                self.cache.put_video(embed_url, video.resolution, video.output_file, video.checksum)
+            return ok, video.downloaded_bytes, video.error
+        except Exception as e:
+            print(f"Error downloading video from {page_url}: {str(e)}")
+            return False, 0, str(e)
+
+# Selector matching any element that carries a BunnyCDN embed URL
+EMBED_SELECTOR = (
+    'iframe[src*="iframe.mediadelivery.net/embed"], '
+    '[data-src*="iframe.mediadelivery.net/embed"], '
+    '[data-video-src*="iframe.mediadelivery.net/embed"]'
+)
+
+def links_selector(base_url):
+    """Selector matching the links an index page is read for"""
+    escaped = base_url.replace("\\", "\\\\").replace('"', '\\"')
+    return f'a[href*="{escaped}"]'
+
+def extract_embed_url_from_html(html):
+    """Run the embed detection methods against raw page HTML"""
+    # Method 1: Look for iframes
+    for src in re.findall(r'<iframe[^>]+src=["\']([^"\']+)["\']', html, re.IGNORECASE):
+        src = unescape(src)
+        if "iframe.mediadelivery.net/embed" in src:
+            return src.split('?')[0]
+
+    # Method 2: Check page source
+    embed_match = re.search(r'(https://iframe\.mediadelivery\.net/embed/[^"\'?]+)', html)
+    if embed_match:
+        return embed_match.group(1)
+
+    # Method 3: Check for data attributes
+    for data_src in re.findall(r'data-(?:video-)?src=["\']([^"\']+)["\']', html, re.IGNORECASE):
+        data_src = unescape(data_src)
+        if "iframe.mediadelivery.net/embed" in data_src:
+            return data_src.split('?')[0]
+
+    return None
+
+class HttpEmbedResolver:
+    """Resolves embed URLs by fetching lesson pages directly, without a browser tab"""
+
+    def __init__(self, cookies, user_agent=None, workers=8, sessions=None):
+        self.workers = max(1, workers)
+        self.owns_sessions = sessions is None
+        self.sessions = sessions or SessionPool(hosts=4, per_host=self.workers)
+        self.session = self.sessions.session()
+        self.session.headers.update({
+            "accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+            "accept-language": "en-US,en;q=0.9",
+            "user-agent": user_agent or BunnyVideoDRM.user_agent["user-agent"],
+        })
+
+        # Reuse the logged-in browser session
+        for cookie in cookies:
+            self.session.cookies.set(
+                cookie["name"], cookie["value"],
+                domain=cookie.get("domain", ""), path=cookie.get("path", "/")
+            )
+
+    def resolve(self, page_url):
+        """Fetch a page and look for an embed URL in its static HTML"""
+        try:
+            with metrics.span("embed_http", url=page_url):
+                response = self.session.get(page_url, timeout=15)
+            if response.status_code != 200:
+                print(f"HTTP {response.status_code} for {page_url}, will use the browser")
+                return None
+            return extract_embed_url_from_html(response.text)
+        except Exception as e:
+            print(f"Error fetching {page_url}: {e}")
+            return None
+
+    def iter_embed_urls(self, page_urls):
+        """Yield (page_url, embed_url or None) for every page, fetching in parallel"""
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self.resolve, page_url): page_url for page_url in page_urls}
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+
+    def close(self):
+        if self.owns_sessions:
+            self.sessions.close()
+
+# How long to wait for pages to become ready, per site. Keys are host names;
+# "default" applies to every site without its own entry.
+#   timeout:       seconds to wait for document.readyState == "complete"
+#   embed_timeout: extra seconds to wait for the video embed to appear
+#   selector:      optional CSS selector that also marks the page as ready
+READINESS_PROFILES = {
+    "default": {"timeout": 15, "embed_timeout": 5, "selector": None},
+}
+
+def load_readiness_profiles(path=None, timeout=None, selector=None):
+    """Build readiness profiles from the defaults, a JSON file and CLI overrides"""
+    profiles = {host: dict(profile) for host, profile in READINESS_PROFILES.items()}
+    if path:
+        with open(path) as f:
+            for host, profile in json.load(f).items():
+                profiles.setdefault(host, dict(profiles["default"])).update(profile)
+    if timeout is not None:
+        profiles["default"]["timeout"] = timeout
+    if selector:
+        profiles["default"]["selector"] = selector
+    return profiles
+
+class BrowserConnectionError(Exception):
+    """Raised when Chrome can't be reached on its remote debugging port"""
 
 class ChromeBrowser:
     """Manages interaction with existing Chrome instance"""
 
-    def __init__(self, debug_port=9222):
+    def __init__(self, debug_port=9222, profiles=None):
         """Connect to existing Chrome instance with remote debugging enabled"""
+        self.profiles = profiles or READINESS_PROFILES
         try:
             options = Options()
             options.add_experimental_option("debuggerAddress", f"127.0.0.1:{debug_port}")
 
             self.driver = webdriver.Chrome(options=options)
-            self.wait = WebDriverWait(self.driver, 15)
+            self.wait = WebDriverWait(self.driver, self.profiles["default"]["timeout"])
 
             # Verify connection
             current_url = self.driver.current_url
@@ -237,10 +2254,10 @@ class ChromeBrowser:
             print(f"Original window handle: {self.original_handle}")
 
         except Exception as e:
-            print(f"Failed to connect to Chrome on port {debug_port}")
-            print(f"Ensure Chrome is running with: --remote-debugging-port={debug_port}")
-            print(f"Error details: {e}")
-            sys.exit(1)
+            raise BrowserConnectionError(
+                f"Failed to connect to Chrome on port {debug_port}. "
+                f"Ensure Chrome is running with: --remote-debugging-port={debug_port}. Error details: {e}"
+            ) from e
 
     def open_new_tab(self, url=None):
         """Open a new tab and optionally navigate to a URL"""
@@ -248,9 +2265,13 @@ class ChromeBrowser:
             # Record current handles
             original_handles = self.driver.window_handles
 
-            # Open new tab
-            self.driver.execute_script("window.open('about:blank');")
-            time.sleep(1)  # Give browser time to open new tab
+            # Open new tab and wait for its handle to show up
+            with metrics.span("tab_open"):
+                self.driver.execute_script("window.open('about:blank');")
+                try:
+                    self.wait.until(lambda driver: len(driver.window_handles) > len(original_handles))
+                except selenium_exceptions.TimeoutException:
+                    pass
 
             # Get new handles
             new_handles = self.driver.window_handles
@@ -266,8 +2287,8 @@ class ChromeBrowser:
             # Navigate to URL if provided
             if url:
                 print(f"Navigating to: {url}")
-                self.driver.get(url)
-                time.sleep(2)  # Wait for initial page load
+                with metrics.span("page_load", url=url):
+                    self.driver.get(url)
 
             return new_tab
         except Exception as e:
@@ -295,6 +2316,67 @@ class ChromeBrowser:
             print(f"Error closing tab: {e}")
             self._ensure_on_original_tab()
 
+    def get_cookies(self):
+        """Return every cookie in the browser profile, for use outside the browser"""
+        try:
+            return self.driver.execute_cdp_cmd("Network.getAllCookies", {})["cookies"]
+        except Exception:
+            # Only the current tab's cookies, but better than nothing
+            return self.driver.get_cookies()
+
+    def get_user_agent(self):
+        """Return the browser's user agent string"""
+        try:
+            return self.driver.execute_script("return navigator.userAgent")
+        except Exception:
+            return None
+
+    def _profile(self, url):
+        """Return the readiness profile for the site serving url"""
+        host = urlparse(url).hostname or ""
+        for key in (host, host[4:] if host.startswith("www.") else "www." + host):
+            if key in self.profiles:
+                return self.profiles[key]
+        return self.profiles["default"]
+
+    def _ready_selectors(self, profile, embed=False, links=None):
+        """Join the selectors a page waits for: the embed, links containing links, and the profile's own"""
+        selectors = (EMBED_SELECTOR if embed else None, links_selector(links) if links else None, profile.get("selector"))
+        return ", ".join(s for s in selectors if s)
+
+    def wait_until_ready(self, url, embed=False, links=None):
+        """Wait until the current tab has finished loading.
+
+        With embed=True, additionally wait for a BunnyCDN embed (or the
+        profile's selector) to appear, so pages that inject the player
+        with JavaScript are caught without a fixed sleep. Index pages pass
+        the base URL as links and wait the same way for their first link.
+        Returns True if the page became ready before the profile's
+        timeouts ran out.
+        """
+        profile = self._profile(url)
+        start = time.time()
+        ready = True
+        try:
+            WebDriverWait(self.driver, profile["timeout"]).until(
+                lambda driver: driver.execute_script("return document.readyState") == "complete"
+            )
+
+            selectors = self._ready_selectors(profile, embed, links)
+            if selectors:
+                WebDriverWait(self.driver, profile.get("embed_timeout", 5)).until(
+                    lambda driver: driver.execute_script(
+                        "return document.querySelector(arguments[0]) !== null", selectors
+                    )
+                )
+        except selenium_exceptions.TimeoutException:
+            ready = False
+
+        state = "ready" if ready else "not ready, continuing"
+        print(f"Waited {time.time() - start:.2f}s for page ({state})")
+        metrics.record_span("page_ready", time.time() - start, start=start, url=url, ready=ready)
+        return ready
+
     def _ensure_on_original_tab(self):
         """Make sure we're on the original tab"""
         try:
@@ -309,43 +2391,123 @@ class ChromeBrowser:
         except Exception as e:
             print(f"Error switching to original tab: {e}")
 
-    def get_page_links(self, url, base_url):
-        """Load a page and extract all links containing the base_url"""
+    def get_page_links(self, url, base_url, depth=0, follow=None, tabs=1):
+        """Collect the links containing base_url from an index page, in page order.
+
+        With depth > 0, "next page" links and links containing follow (e.g.
+        "/modules/") are crawled too, up to depth levels away from url, each
+        level in a pool of tabs. Links come back in course order: the pages
+        of a level in the order they were linked, each page's own links
+        first, and every link only once.
+        """
+        found = {}  # page URL -> (position in the crawl tree, links)
+        level = [(url, ())]
+        seen = {url}
+        for current_depth in range(depth + 1):
+            positions = dict(level)
+            results = self._iter_pool(
+                list(positions), tabs, lambda page: self._pooled_links(page, base_url, follow),
+                lambda page: self._load_links(page, base_url, follow), links=base_url
+            ) if tabs > 1 and len(level) > 1 else (
+                (page, self._load_links(page, base_url, follow)) for page in positions
+            )
+
+            next_level = []
+            for page, result in results:
+                links, pages = result or ([], [])
+                found[page] = (positions[page], links)
+                if current_depth == depth:
+                    continue
+                for i, next_page in enumerate(pages):
+                    if next_page not in seen:
+                        seen.add(next_page)
+                        next_level.append((next_page, positions[page] + (i,)))
+            if not next_level:
+                break
+            print(f"Following {len(next_level)} more index pages")
+            level = next_level
+
+        ordered = sorted(found.values(), key=lambda item: item[0])
+        unique_links = list(dict.fromkeys(link for _, links in ordered for link in links))
+        print(f"Found {len(unique_links)} unique links containing '{base_url}' on {len(found)} pages")
+        return unique_links
+
+    def _load_links(self, url, base_url, follow=None):
+        """Load an index page in its own tab and return (links, index pages to follow)"""
         tab_handle = None
         try:
             # Open new tab for this operation
             tab_handle = self.open_new_tab(url)
             if not tab_handle:
-                return []
+                return [], []
 
             print(f"Extracting links from {url} containing '{base_url}'...")
 
             # Wait for page to load properly
-            time.sleep(3)
-
-            # Find all links
-            links = []
-            elements = self.driver.find_elements(By.TAG_NAME, "a")
-
-            for element in elements:
-                try:
-                    href = element.get_attribute("href")
-                    if href and base_url in href:
-                        links.append(href)
-                except Exception:
-                    continue
-
-            unique_links = list(set(links))
-            print(f"Found {len(unique_links)} unique links containing '{base_url}'")
-            return unique_links
+            self.wait_until_ready(url, links=base_url)
+            return self._collect_links(url, base_url, follow)
 
         except Exception as e:
             print(f"Error extracting links from {url}: {e}")
-            return []
+            return [], []
         finally:
             if tab_handle:
                 self.close_tab(tab_handle)
 
+    def _pooled_links(self, url, base_url, follow=None):
+        print(f"Extracting links from {url} containing '{base_url}'...")
+        try:
+            return self._collect_links(url, base_url, follow)
+        except Exception as e:
+            print(f"Error extracting links from {url}: {e}")
+            return [], []
+
+    def _collect_links(self, url, base_url, follow=None):
+        """Return (links, index pages to follow) from the current tab in one round trip.
+
+        Elements matching the profile's "expand" selector (collapsed course
+        modules, "show more" buttons) are clicked first, and the links are
+        read once their number stops changing.
+        """
+        expand = self._profile(url).get("expand")
+        if expand:
+            count = self.driver.execute_script(
+                "var els = document.querySelectorAll(arguments[0]);"
+                "els.forEach(function (el) { try { el.click(); } catch (e) {} });"
+                "return els.length;", expand
+            )
+            if count:
+                self._wait_for_links_to_settle(url)
+
+        with metrics.span("link_extract", url=url):
+            links, pages = self.driver.execute_script("""
+                var base = arguments[0], follow = arguments[1], links = [], pages = [];
+                document.querySelectorAll("a[href]").forEach(function (a) {
+                    var href = a.href, text = (a.textContent || "").trim();
+                    if (!href || href.startsWith("javascript:")) return;
+                    if (href.indexOf(base) !== -1) {
+                        links.push(href);
+                    } else if ((follow && href.indexOf(follow) !== -1) || /(^|\\s)next(\\s|$)/i.test(a.rel)
+                               || /^(next|older)\\b|^[»›→]$/i.test(text)) {
+                        pages.push(href.split("#")[0]);
+                    }
+                });
+                return [links, pages];
+            """, base_url, follow)
+        return links, list(dict.fromkeys(pages))
+
+    def _wait_for_links_to_settle(self, url):
+        """Wait until the number of links on the page has stopped changing for half a second"""
+        deadline = time.time() + self._profile(url).get("embed_timeout", 5)
+        last, stable_since = None, time.time()
+        while time.time() < deadline:
+            count = self.driver.execute_script("return document.querySelectorAll('a[href]').length;")
+            if count != last:
+                last, stable_since = count, time.time()
+            elif time.time() - stable_since >= 0.5:
+                return
+            time.sleep(0.1)
+
     def find_bunny_embed_url(self, page_url):
         """Load a page and find the BunnyCDN video embed URL"""
         tab_handle = None
@@ -357,48 +2519,12 @@ class ChromeBrowser:
 
             print(f"Looking for video embed in {page_url}...")
 
-            # Wait for page to load
-            time.sleep(3)
+            # Wait for page to load and the player to appear
+            self.wait_until_ready(page_url, embed=True)
 
             # Try multiple methods to find the embed URL
-            embed_url = None
-
-            # Method 1: Look for iframes
-            try:
-                iframes = self.driver.find_elements(By.TAG_NAME, "iframe")
-                for iframe in iframes:
-                    src = iframe.get_attribute("src")
-                    if src and "iframe.mediadelivery.net/embed" in src:
-                        # Get base URL without query parameters
-                        embed_url = src.split('?')[0]
-                        print(f"Found embed URL in iframe: {embed_url}")
-                        break
-            except Exception as e:
-                print(f"Error finding iframe: {e}")
-
-            # Method 2: Check page source
-            if not embed_url:
-                try:
-                    page_source = self.driver.page_source
-                    embed_match = re.search(r'(https://iframe\.mediadelivery\.net/embed/[^"\'?]+)', page_source)
-                    if embed_match:
-                        embed_url = embed_match.group(1)
-                        print(f"Found embed URL in page source: {embed_url}")
-                except Exception as e:
-                    print(f"Error searching page source: {e}")
-
-            # Method 3: Check for data attributes
-            if not embed_url:
-                try:
-                    elements = self.driver.find_elements(By.CSS_SELECTOR, "[data-src], [data-video-src]")
-                    for element in elements:
-                        data_src = element.get_attribute("data-src") or element.get_attribute("data-video-src")
-                        if data_src and "iframe.mediadelivery.net/embed" in data_src:
-                            embed_url = data_src.split('?')[0]
-                            print(f"Found embed URL in data attribute: {embed_url}")
-                            break
-                except Exception as e:
-                    print(f"Error checking data attributes: {e}")
+            with metrics.span("embed_extract", url=page_url):
+                embed_url = self._extract_embed_url()
 
             if not embed_url:
                 print(f"No BunnyCDN embed found in {page_url}")
@@ -412,6 +2538,182 @@ class ChromeBrowser:
             if tab_handle:
                 self.close_tab(tab_handle)
 
+    def _extract_embed_url(self):
+        """Try multiple methods to find the embed URL in the current tab"""
+        embed_url = None
+
+        # Method 1: Look for iframes
+        try:
+            iframes = self.driver.find_elements(By.TAG_NAME, "iframe")
+            for iframe in iframes:
+                src = iframe.get_attribute("src")
+                if src and "iframe.mediadelivery.net/embed" in src:
+                    # Get base URL without query parameters
+                    embed_url = src.split('?')[0]
+                    print(f"Found embed URL in iframe: {embed_url}")
+                    break
+        except Exception as e:
+            print(f"Error finding iframe: {e}")
+
+        # Method 2: Check page source
+        if not embed_url:
+            try:
+                page_source = self.driver.page_source
+                embed_match = re.search(r'(https://iframe\.mediadelivery\.net/embed/[^"\'?]+)', page_source)
+                if embed_match:
+                    embed_url = embed_match.group(1)
+                    print(f"Found embed URL in page source: {embed_url}")
+            except Exception as e:
+                print(f"Error searching page source: {e}")
+
+        # Method 3: Check for data attributes
+        if not embed_url:
+            try:
+                elements = self.driver.find_elements(By.CSS_SELECTOR, "[data-src], [data-video-src]")
+                for element in elements:
+                    data_src = element.get_attribute("data-src") or element.get_attribute("data-video-src")
+                    if data_src and "iframe.mediadelivery.net/embed" in data_src:
+                        embed_url = data_src.split('?')[0]
+                        print(f"Found embed URL in data attribute: {embed_url}")
+                        break
+            except Exception as e:
+                print(f"Error checking data attributes: {e}")
+
+        return embed_url
+
+    def iter_embed_urls(self, page_urls, tabs=1):
+        """Yield (page_url, embed_url) for every page, in the order they finish.
+
+        With tabs > 1, a pool of tabs navigates to several pages at once;
+        each tab is reused for the next page as soon as its embed has been
+        extracted. Pool tabs are closed at the end, the original tab never is.
+        """
+        if tabs <= 1:
+            for page_url in page_urls:
+                yield page_url, self.find_bunny_embed_url(page_url)
+            return
+        yield from self._iter_pool(page_urls, tabs, self._pooled_embed_url, self.find_bunny_embed_url, embed=True)
+
+    def _pooled_embed_url(self, page_url):
+        print(f"Looking for video embed in {page_url}...")
+        try:
+            with metrics.span("embed_extract", url=page_url):
+                embed_url = self._extract_embed_url()
+        except Exception as e:
+            print(f"Error finding embed URL in {page_url}: {e}")
+            embed_url = None
+        if not embed_url:
+            print(f"No BunnyCDN embed found in {page_url}")
+        return embed_url
+
+    def _iter_pool(self, urls, tabs, extract, load_one, embed=False, links=None):
+        """Load urls in a pool of tabs and yield (url, extract(url)) as each page becomes ready.
+
+        extract runs with the finished page's tab selected. load_one handles
+        a single page from start to finish, for when the pool can't be used.
+        """
+        pending = deque(urls)
+        pool = []
+        try:
+            for _ in range(min(tabs, len(pending))):
+                handle = self.open_new_tab()
+                if handle and handle != self.original_handle and handle not in pool:
+                    pool.append(handle)
+            if not pool:
+                print("Warning: Failed to open a tab pool, falling back to one tab at a time")
+            else:
+                print(f"Opened a pool of {len(pool)} tabs")
+
+            free = list(pool)
+            active = {}  # handle -> [url, started, loaded_at]
+            while pending or active:
+                # Start loading pages in idle tabs
+                while free and pending:
+                    handle = free.pop()
+                    url = pending.popleft()
+                    if self._navigate_tab(handle, url):
+                        active[handle] = [url, time.time(), None]
+                    else:
+                        pool.remove(handle)
+                        yield url, None
+
+                if not active:
+                    break
+
+                # Extract from whichever tab finishes first
+                finished = None
+                for handle, state in list(active.items()):
+                    try:
+                        if self._tab_finished(handle, state, embed, links):
+                            finished = handle
+                            break
+                    except Exception as e:
+                        print(f"Error polling tab for {state[0]}: {e}")
+                        del active[handle]
+                        pool.remove(handle)
+                        yield state[0], None
+
+                if finished is None:
+                    time.sleep(0.1)
+                    continue
+
+                url, started, _ = active.pop(finished)
+                print(f"Page ready after {time.time() - started:.2f}s: {url}")
+                metrics.record_span("page_ready", time.time() - started, start=started, url=url, pooled=True)
+                result = extract(url)
+                free.append(finished)
+                yield url, result
+
+            # Whatever is left if every pool tab died
+            while pending:
+                url = pending.popleft()
+                yield url, load_one(url)
+        finally:
+            for handle in pool:
+                self.close_tab(handle)
+
+    def _navigate_tab(self, handle, url):
+        """Start loading url in a pool tab without waiting for it to finish"""
+        try:
+            self.driver.switch_to.window(handle)
+            print(f"Navigating to: {url}")
+            # Mark the old document so its readyState isn't mistaken for the new page's
+            self.driver.execute_script(
+                "document.documentElement.setAttribute('data-bvd-stale', '1');"
+                "window.location.href = arguments[0];", url
+            )
+            return True
+        except Exception as e:
+            print(f"Error navigating tab to {url}: {e}")
+            return False
+
+    def _tab_finished(self, handle, state, embed=True, links=None):
+        """Check, without blocking, whether a pool tab is ready for extraction"""
+        page_url, started, loaded_at = state
+        profile = self._profile(page_url)
+        # ":root" always matches, so pages without anything to wait for are ready once loaded
+        selectors = self._ready_selectors(profile, embed, links) or ":root"
+
+        self.driver.switch_to.window(handle)
+        ready_state, has_selector = self.driver.execute_script(
+            "var stale = document.documentElement.hasAttribute('data-bvd-stale');"
+            "return [stale ? 'loading' : document.readyState,"
+            "        !stale && document.querySelector(arguments[0]) !== null];", selectors
+        )
+
+        now = time.time()
+        if ready_state == "complete":
+            if has_selector:
+                return True
+            if loaded_at is None:
+                state[2] = loaded_at = now
+            # Loaded but no player or links yet: give it the profile's embed grace period
+            return now - loaded_at >= profile.get("embed_timeout", 5)
+        if now - started >= profile["timeout"]:
+            print(f"Timed out waiting for {page_url}, continuing")
+            return True
+        return False
+
     def cleanup(self):
         """Clean up browser resources without closing the original window"""
         try:
@@ -431,88 +2733,877 @@ class ChromeBrowser:
             print(f"Error during browser cleanup: {e}")
             self._ensure_on_original_tab()
 
-def download_videos(main_url, base_url, output_path="", debug_port=9222):
-    """Main function to extract links and download videos"""
-    browser = None
-    try:
-        # Connect to Chrome
-        browser = ChromeBrowser(debug_port=debug_port)
+def name_from_url(page_url, index):
+    """Create a filename from the last path component of a page URL"""
+    path_parts = urlparse(page_url).path.strip('/').split('/')
+    name = path_parts[-1] if path_parts and path_parts[-1] else f"video_{index}"
+    return name.replace('-', '_').replace('.', '_')  # Clean up filename
+
+def resolve_embeds(browser, page_links, tabs=1, http_resolver=None):
+    """Yield (page_url, embed_url) for every page.
+
+    With an HTTP resolver, pages are fetched directly first and only the
+    ones whose embed isn't in the static HTML are opened in the browser.
+    """
+    if http_resolver:
+        misses = []
+        for page_url, embed_url in http_resolver.iter_embed_urls(page_links):
+            if embed_url:
+                print(f"Found embed URL over HTTP for {page_url}: {embed_url}")
+                yield page_url, embed_url
+            else:
+                misses.append(page_url)
+
+        # Keep course order for the pages that need the browser
+        positions = {page_url: i for i, page_url in enumerate(page_links)}
+        page_links = sorted(misses, key=positions.get)
+        if page_links:
+            print(f"\n{len(page_links)} pages need the browser to find their embed")
+
+    yield from browser.iter_embed_urls(page_links, tabs=tabs)
+
+def discover_embeds(get_browser, page_links, scheduler, stats, tabs=1, get_http_resolver=None, cache=None,
+                    manifest=None, output_path=None, names=None, job=None):
+    """Discovery stage: resolve embed URLs and hand them to the download stage.
+
+    Pages already in the cache skip the browser entirely, and videos already
+    on disk aren't queued at all. get_browser and get_http_resolver are
+    called only if some page actually needs resolving. names optionally maps
+    page URLs to output names; other pages are named after their URL.
+    Discovery stops early if job is cancelled.
+    """
+    names = names or {}
+    positions = {page_url: i for i, page_url in enumerate(page_links, 1)}
+
+    def completed_file(embed_url):
+        return (cache and cache.completed_file(embed_url)) or (manifest and manifest.completed_file(embed_url))
+
+    unresolved = []
+    for page_url in page_links:
+        embed_url = cache.get_embed(page_url) if cache else None
+        if not embed_url:
+            unresolved.append(page_url)
+            continue
+        existing = completed_file(embed_url)
+        if existing:
+            print(f"[{positions[page_url]}/{len(page_links)}] Already downloaded: {existing}")
+            scheduler.record_skip(embed_url, job)
+            continue
+        print(f"[{positions[page_url]}/{len(page_links)}] Using cached embed for {page_url}")
+        name = names.get(page_url) or name_from_url(page_url, positions[page_url])
+        stats.record_blocked(scheduler.submit(page_url, embed_url, name, output_path, job))
+
+    if not unresolved:
+        return
+
+    http_resolver = get_http_resolver() if get_http_resolver else None
+    start = time.time()
+    for page_url, embed_url in resolve_embeds(get_browser(), unresolved, tabs, http_resolver):
+        if job and job.cancelled.is_set():
+            print(f"Job {job.id} cancelled, stopping discovery")
+            break
+        i = positions[page_url]
+        print(f"\n[{i}/{len(page_links)}] Processed: {page_url}")
+        stats.record(time.time() - start, ok=bool(embed_url))
+        if not embed_url:
+            print(f"Skipping {page_url} - no embed URL found")
+            scheduler.record_failure(page_url, job)
+            start = time.time()
+            continue
+
+        if cache:
+            cache.put_embed(page_url, embed_url)
+        existing = completed_file(embed_url)
+        if existing:
+            print(f"Already downloaded: {existing}")
+            scheduler.record_skip(embed_url, job)
+            start = time.time()
+            continue
+
+        # Blocks while the download stage is saturated
+        name = names.get(page_url) or name_from_url(page_url, i)
+        stats.record_blocked(scheduler.submit(page_url, embed_url, name, output_path, job))
+        start = time.time()
+
+def parse_batch(lines, output_path=""):
+    """Parse a batch manifest into a list of entries.
+
+    One entry per line; blank lines and lines starting with # are ignored:
+
+        index <index_url> <base_url>   all lessons linked from an index page
+        lesson <page_url> [name]       a single lesson page
+        embed <embed_url> [name]       a BunnyCDN embed URL, no page needed
+        <url> [name]                   an embed URL if it looks like one, otherwise a lesson page
+
+    Videos from each index page go to their own subdirectory of output_path.
+    """
+    entries = []
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        parts = line.split(None, 1)
+        kind = parts[0].lower() if parts[0].lower() in ("index", "lesson", "embed") else None
+        if kind:
+            parts = parts[1].split(None, 1) if len(parts) > 1 else []
+        if not parts:
+            raise ValueError(f"Line {number}: missing URL")
+        url, rest = parts[0], (parts[1].strip() if len(parts) > 1 else "")
+        try:
+            entries.append(batch_entry(kind, url, rest, output_path, len(entries) + 1))
+        except ValueError as e:
+            raise ValueError(f"Line {number}: {e}")
+    return entries
+
+def batch_entry(kind, url, rest="", output_path="", position=1):
+    """Build one batch entry. rest is the base URL filter of an index page, or the name of a video.
+
+    kind may be None to tell lesson pages and embed URLs apart by their URL.
+    """
+    if kind is None:
+        kind = "embed" if "iframe.mediadelivery.net/embed/" in url else "lesson"
+    if kind not in ("index", "lesson", "embed"):
+        raise ValueError(f"unknown entry kind {kind!r}")
+    if kind == "index":
+        if not rest:
+            raise ValueError("index entries need a base URL filter")
+        course = name_from_url(url, position)
+        return {"kind": "index", "url": url, "base_url": rest, "path": os.path.join(output_path or ".", course)}
+    if rest and (re.search(r"[/\\\0]", rest) or not rest.strip(". ")):
+        raise ValueError(f"invalid video name {rest!r}: names can't contain path separators or be just dots")
+    return {"kind": kind, "url": url.split("?")[0] if kind == "embed" else url, "name": rest}
+
+def queue_entries(entries, scheduler, get_browser, stats, tabs=1, get_http_resolver=None, cache=None, manifest=None,
+                  crawl_depth=0, follow=None, job=None):
+    """Discover the videos behind a list of batch entries and queue them with the scheduler.
+
+    Embed URLs are queued straight away, loose lesson pages are resolved
+    together, then every index page is crawled in turn; a lesson linked from
+    several entries is only handled once. Returns the number of lesson pages
+    and embeds found.
+    """
+    total_links = 0
+    seen_pages = set()
+
+    # Direct embeds need no discovery at all
+    for entry in entries:
+        if entry["kind"] != "embed":
+            continue
+        total_links += 1
+        scheduler.add_videos(1)
+        existing = (cache and cache.completed_file(entry["url"])) or (manifest and manifest.completed_file(entry["url"]))
+        if existing:
+            print(f"Already downloaded: {existing}")
+            scheduler.record_skip(entry["url"], job)
+            continue
+        name = entry["name"] or f"video_{urlparse(entry['url']).path.split('/')[-1]}"
+        scheduler.submit(entry["url"], entry["url"], name, job=job)
+
+    # Loose lesson pages are resolved together
+    lessons = [e for e in entries if e["kind"] == "lesson" and e["url"] not in seen_pages]
+    if lessons:
+        page_links = list(dict.fromkeys(e["url"] for e in lessons))
+        seen_pages.update(page_links)
+        total_links += len(page_links)
+        scheduler.add_videos(len(page_links))
+        discover_embeds(
+            get_browser, page_links, scheduler, stats,
+            tabs=tabs, get_http_resolver=get_http_resolver, cache=cache, manifest=manifest,
+            names={e["url"]: e["name"] for e in lessons if e["name"]}, job=job
+        )
+
+    for entry in entries:
+        if entry["kind"] != "index" or (job and job.cancelled.is_set()):
+            continue
+        main_url, base_url = entry["url"], entry["base_url"]
 
         # Extract all links from main page
-        page_links = browser.get_page_links(main_url, base_url)
+        page_links = cache.get_links(main_url, base_url, crawl_depth, follow) if cache else None
+        if page_links:
+            print(f"Using {len(page_links)} cached links for {main_url}")
+        else:
+            page_links = get_browser().get_page_links(main_url, base_url, depth=crawl_depth, follow=follow, tabs=tabs)
+            if cache and page_links:
+                cache.put_links(main_url, base_url, page_links, crawl_depth, follow)
 
+        # Lessons shared between courses are only handled once
+        page_links = [link for link in page_links or [] if link not in seen_pages]
         if not page_links:
-            print("No links found matching the base URL. Please check your parameters.")
-            return
+            print(f"No new links found in {main_url} matching the base URL. Please check your parameters.")
+            continue
+        seen_pages.update(page_links)
+        total_links += len(page_links)
+        scheduler.add_videos(len(page_links))
 
-        successful_downloads = 0
-        failed_downloads = 0
+        discover_embeds(
+            get_browser, page_links, scheduler, stats,
+            tabs=tabs, get_http_resolver=get_http_resolver, cache=cache, manifest=manifest,
+            output_path=entry["path"], job=job
+        )
 
-        # Process each link
-        for i, page_url in enumerate(page_links, 1):
-            print(f"\n[{i}/{len(page_links)}] Processing: {page_url}")
+    return total_links
 
-            # Find video embed URL
-            embed_url = browser.find_bunny_embed_url(page_url)
-            if not embed_url:
-                print(f"Skipping {page_url} - no embed URL found")
-                failed_downloads += 1
-                continue
-
-            # Create a filename from the URL
-            path_parts = urlparse(page_url).path.strip('/').split('/')
-            name = path_parts[-1] if path_parts else f"video_{i}"
-            name = name.replace('-', '_').replace('.', '_')  # Clean up filename
-
-            # Download the video
-            try:
-                video = BunnyVideoDRM(
-                    referer=page_url,
-                    embed_url=embed_url,
-                    name=name,
-                    path=output_path
-                )
+def download_videos(main_url, base_url, output_path="", **options):
+    """Main function to extract links and download videos"""
+    return download_batch(
+        [{"kind": "index", "url": main_url, "base_url": base_url, "path": output_path}],
+        output_path, **options
+    )
 
-                if video.download():
-                    successful_downloads += 1
-                else:
-                    failed_downloads += 1
+def download_batch(entries, output_path="", debug_port=9222, jobs=1, max_connections=32, queue_size=0,
+                    profiles=None, tabs=1, http_discovery=False, http_workers=8, use_cache=True, refresh_cache=False,
+                    resume=False, engine="yt-dlp", policy=None, crawl_depth=0, follow=None, preallocate=True,
+                    rate_limiter=None, schedule="fifo", browser=None):
+    """Download everything listed in a batch of index, lesson and embed entries.
+
+    All entries share one browser connection, HTTP connection pools, cache,
+    job manifest and download scheduler, and each video is downloaded only
+    once even if several entries lead to it. An already connected browser
+    may be passed in; it is then left for the caller to clean up. Returns a
+    dict of summary counters and stage stats, or None if nothing was
+    downloaded. Raises BrowserConnectionError if Chrome was needed but
+    couldn't be reached.
+    """
+    own_browser = browser is None
+    scheduler = None
+    http_resolver = None
+    # One connection pool per host for the whole run: DRM calls, segments and lesson pages
+    sessions = SessionPool(per_host=max(max_connections + jobs, http_workers))
+    cache = None
+    manifest = None
+
+    def get_browser():
+        # Connect to Chrome only once something actually needs it
+        nonlocal browser
+        if browser is None:
+            browser = ChromeBrowser(debug_port=debug_port, profiles=profiles)
+        return browser
+
+    def get_http_resolver():
+        nonlocal http_resolver
+        if http_discovery and http_resolver is None:
+            http_resolver = HttpEmbedResolver(
+                get_browser().get_cookies(),
+                user_agent=get_browser().get_user_agent(),
+                workers=http_workers,
+                sessions=sessions
+            )
+        return http_resolver
 
-            except Exception as e:
-                print(f"Error downloading video from {page_url}: {str(e)}")
-                failed_downloads += 1
+    try:
+        os.makedirs(output_path or ".", exist_ok=True)
+        if use_cache:
+            cache = ResolutionCache(os.path.join(output_path or ".", ".bvd-cache.sqlite"), refresh=refresh_cache)
+        manifest = JobManifest(os.path.join(output_path or ".", ".bvd-manifest.json"))
+
+        # The browser resolves upcoming pages while workers download earlier ones
+        scheduler = DownloadScheduler(
+            jobs=jobs,
+            max_connections=max_connections,
+            output_path=output_path,
+            queue_size=queue_size,
+            cache=cache,
+            manifest=manifest,
+            resume=resume,
+            engine=engine,
+            policy=policy,
+            sessions=sessions,
+            preallocate=preallocate,
+            rate_limiter=rate_limiter,
+            schedule=schedule
+        )
+        scheduler.start()
+
+        print(scheduler.disk.summary())
+        if policy and policy.budget and policy.budget > scheduler.disk.free():
+            print(f"Warning: the size budget is larger than the free space in {scheduler.disk.path}")
+
+        # Interrupted videos go first, straight from the manifest
+        if resume:
+            unfinished = manifest.unfinished()
+            if unfinished:
+                print(f"Resuming {len(unfinished)} unfinished videos from the job manifest")
+            for job in unfinished.values():
+                if job.get("embed_url"):
+                    scheduler.add_videos(1)
+                    scheduler.submit(job["page_url"], job["embed_url"], job.get("name", ""), job.get("path"))
+
+        discovery_stats = StageStats("Discovery")
+        total_links = queue_entries(
+            entries, scheduler, get_browser, discovery_stats,
+            tabs=tabs, get_http_resolver=get_http_resolver, cache=cache, manifest=manifest,
+            crawl_depth=crawl_depth, follow=follow
+        )
+
+        # Resumed videos may still be downloading even if nothing new was found
+        scheduler.close()
+        if not total_links:
+            return
 
         # Show summary
         print(f"\nDownload summary:")
-        print(f"Total links found: {len(page_links)}")
-        print(f"Successfully downloaded: {successful_downloads}")
-        print(f"Failed: {failed_downloads}")
+        print(f"Total links found: {total_links}")
+        print(f"Already downloaded: {scheduler.skipped}")
+        if scheduler.duplicates:
+            print(f"Duplicates skipped: {scheduler.duplicates}")
+        print(f"Successfully downloaded: {scheduler.successful}")
+        print(f"Failed: {scheduler.failed}")
+        print(discovery_stats.summary())
+        print(scheduler.stats.summary())
+        print(scheduler.queue.summary())
+        print(scheduler.concurrency.summary())
+        print(sessions.summary())
+        print(scheduler.disk.summary())
+        print(scheduler.rate_limiter.summary())
+        if policy and policy.summary():
+            print(policy.summary())
+        print("Time per stage:")
+        for line in metrics.summary():
+            print(f"  {line}")
+
+        return {
+            "links": total_links,
+            "skipped": scheduler.skipped,
+            "duplicates": scheduler.duplicates,
+            "successful": scheduler.successful,
+            "failed": scheduler.failed,
+            "discovery": discovery_stats,
+            "download": scheduler.stats,
+            "queue": scheduler.queue,
+        }
 
+    except BrowserConnectionError:
+        raise
     except Exception as e:
         print(f"Error in download process: {e}")
     finally:
-        if browser:
+        if scheduler:
+            # Only still running on Ctrl-C or an error: stop instead of working through the queue
+            scheduler.close(cancel=True)
+        if http_resolver:
+            http_resolver.close()
+        sessions.close()
+        if browser and own_browser:
             browser.cleanup()
+        if cache:
+            cache.close()
+        if manifest:
+            manifest.save()
+
+class Job:
+    """One submission to the download service and the videos it led to"""
+
+    def __init__(self, job_id, entries, rate_limiter=None):
+        self.id = job_id
+        self.entries = entries
+        self.rate_limiter = rate_limiter
+        self.created = time.time()
+        self.discovering = True
+        self.error = None
+        self.cancelled = threading.Event()
+        self.videos = {}  # guid (or page URL, if no embed was found) -> progress dict
+        self.samples = deque(maxlen=10)  # (time, bytes) for the transfer rate
+        self.lock = threading.Lock()
+
+    def add_video(self, key, name, state="queued", error=None):
+        with self.lock:
+            self.videos[key] = {"name": name, "state": state, "error": error, "video": None}
+
+    def start_video(self, guid, video):
+        with self.lock:
+            entry = self.videos.setdefault(guid, {"name": video.file_name, "error": None})
+            entry.update(name=video.file_name, state="downloading", video=video)
+
+    def finish_video(self, guid, state, error=None):
+        with self.lock:
+            entry = self.videos.setdefault(guid, {"name": "", "video": None})
+            entry.update(state=state, error=error)
+
+    def cancel(self):
+        self.cancelled.set()
+        with self.lock:
+            for entry in self.videos.values():
+                if entry["state"] == "queued":
+                    entry["state"] = "cancelled"
+
+    def _bytes(self):
+        return sum(entry["video"].downloaded_bytes for entry in self.videos.values() if entry["video"])
+
+    def sample(self):
+        """Record the bytes downloaded so far; called about once a second"""
+        with self.lock:
+            self.samples.append((time.time(), self._bytes()))
+
+    @property
+    def finished(self):
+        return self.state in ("done", "failed", "cancelled")
+
+    @property
+    def state(self):
+        with self.lock:
+            states = [entry["state"] for entry in self.videos.values()]
+        if self.cancelled.is_set():
+            return "cancelled" if self.discovering or "downloading" not in states else "cancelling"
+        if self.discovering:
+            return "discovering"
+        if "queued" in states or "downloading" in states:
+            return "downloading"
+        if self.error or (states and all(state == "failed" for state in states)):
+            return "failed"
+        return "done"
+
+    def progress(self, details=True):
+        """Return the job's progress as a JSON-serialisable dict"""
+        state = self.state
+        with self.lock:
+            downloaded = self._bytes()
+            counts = {}
+            videos = []
+            for key, entry in self.videos.items():
+                counts[entry["state"]] = counts.get(entry["state"], 0) + 1
+                video = entry["video"]
+                size = video.estimated_size() if video and getattr(video, "bandwidth", None) is not None else None
+                videos.append({
+                    "id": key,
+                    "name": entry["name"],
+                    "state": entry["state"],
+                    "bytes": video.downloaded_bytes if video else 0,
+                    "estimated_bytes": size,
+                    "file": getattr(video, "output_file", None) if video else None,
+                    "error": entry["error"],
+                })
+            rate = 0.0
+            if len(self.samples) > 1 and state not in ("done", "failed", "cancelled"):
+                (start, first), (end, last) = self.samples[0], self.samples[-1]
+                rate = (last - first) / (end - start) if end > start else 0.0
+
+        # Videos whose size isn't known yet are assumed to be as large as the average known one
+        wanted = [v for v in videos if v["state"] in ("queued", "downloading", "done")]
+        known = [v["estimated_bytes"] for v in wanted if v["estimated_bytes"]]
+        estimated = sum(known) + (len(wanted) - len(known)) * sum(known) / len(known) if known else 0
+        eta = None
+        if state == "downloading" and rate > 0 and estimated > downloaded:
+            eta = (estimated - downloaded) / rate
+        result = {
+            "id": self.id,
+            "state": state,
+            "entries": self.entries,
+            "created": self.created,
+            "videos": counts,
+            "bytes": downloaded,
+            "estimated_bytes": int(estimated) or None,
+            "rate": rate,
+            "allowed_rate": self.rate_limiter.allowed(self.id) if self.rate_limiter else None,
+            "eta": eta,
+            "error": self.error,
+        }
+        if details:
+            result["items"] = videos
+        return result
+
+class DownloadService:
+    """Long-running download service controlled over a small local HTTP API.
+
+    One browser connection, connection pool, cache, job manifest and
+    download scheduler are kept for the life of the service, so every
+    submission starts warm and all jobs share the same connection budget.
+    Jobs are discovered one at a time (the browser can only do one thing
+    at a time) and downloaded by the scheduler's workers.
+
+        POST   /jobs             submit a job: JSON {"url", "base_url", "kind", "name"}
+                                 (base_url only for index pages), a list of those, or a
+                                 batch file as text/plain
+        GET    /jobs             every job with its progress
+        GET    /jobs/ID          one job's progress: bytes, rate, ETA and each video
+        DELETE /jobs/ID          cancel a job (or POST /jobs/ID/cancel)
+        GET    /status           queue, concurrency and connection summaries
+    """
+
+    def __init__(self, output_path="", debug_port=9222, jobs=1, max_connections=32, queue_size=0, profiles=None,
+                 tabs=1, http_discovery=False, http_workers=8, use_cache=True, refresh_cache=False, resume=False,
+                 engine="yt-dlp", policy=None, crawl_depth=0, follow=None, preallocate=True, rate_limiter=None,
+                 schedule="fifo", browser=None):
+        self.output_path = output_path
+        self.debug_port = debug_port
+        self.profiles = profiles
+        self.tabs = tabs
+        self.http_discovery = http_discovery
+        self.http_workers = http_workers
+        self.crawl_depth = crawl_depth
+        self.follow = follow
+        self.browser = browser
+        self.own_browser = browser is None
+        self.http_resolver = None
+
+        os.makedirs(output_path or ".", exist_ok=True)
+        self.sessions = SessionPool(per_host=max(max_connections + jobs, http_workers))
+        self.cache = None
+        if use_cache:
+            self.cache = ResolutionCache(os.path.join(output_path or ".", ".bvd-cache.sqlite"), refresh=refresh_cache)
+        self.manifest = JobManifest(os.path.join(output_path or ".", ".bvd-manifest.json"))
+        self.scheduler = DownloadScheduler(
+            jobs=jobs,
+            max_connections=max_connections,
+            output_path=output_path,
+            queue_size=queue_size,
+            cache=self.cache,
+            manifest=self.manifest,
+            resume=resume,
+            engine=engine,
+            policy=policy,
+            sessions=self.sessions,
+            preallocate=preallocate,
+            rate_limiter=rate_limiter,
+            schedule=schedule
+        )
+        self.discovery_stats = StageStats("Discovery")
+        self.jobs = {}
+        self.next_id = 1
+        self.lock = threading.Lock()
+        self.pending = queue.Queue()
+        self.stopping = threading.Event()
+        self.server = None
+        self.threads = []
+
+    def start(self):
+        """Start the download workers, the discovery thread and the progress sampler"""
+        self.scheduler.start()
+        for target, name in ((self._discover, "discovery"), (self._sample, "progress")):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, entries):
+        """Queue a list of batch entries as one job and return it"""
+        with self.lock:
+            job = Job(str(self.next_id), entries, self.scheduler.rate_limiter)
+            self.next_id += 1
+            self.jobs[job.id] = job
+        print(f"Job {job.id}: {len(entries)} entries queued")
+        self.pending.put(job)
+        return job
+
+    def all_jobs(self):
+        """Return a snapshot of the jobs, safe to iterate while others are submitted"""
+        with self.lock:
+            return list(self.jobs.values())
+
+    def cancel(self, job_id):
+        job = self.jobs.get(job_id)
+        if job and not job.finished:
+            print(f"Job {job_id}: cancelling")
+            job.cancel()
+        return job
+
+    def status(self):
+        states = [job.state for job in self.all_jobs()]
+        return {
+            "jobs": {state: states.count(state) for state in set(states)},
+            "successful": self.scheduler.successful,
+            "failed": self.scheduler.failed,
+            "skipped": self.scheduler.skipped,
+            "cancelled": self.scheduler.cancelled,
+            "rate": self.scheduler.rate_limiter.achieved(),
+            "allowed_rate": self.scheduler.rate_limiter.allowed(),
+            "summary": [
+                self.discovery_stats.summary(),
+                self.scheduler.stats.summary(),
+                self.scheduler.queue.summary(),
+                self.scheduler.concurrency.summary(),
+                self.sessions.summary(),
+                self.scheduler.disk.summary(),
+                self.scheduler.rate_limiter.summary(),
+            ],
+        }
+
+    def _get_browser(self):
+        if self.browser is None:
+            self.browser = ChromeBrowser(debug_port=self.debug_port, profiles=self.profiles)
+        return self.browser
+
+    def _get_http_resolver(self):
+        if self.http_discovery and self.http_resolver is None:
+            self.http_resolver = HttpEmbedResolver(
+                self._get_browser().get_cookies(),
+                user_agent=self._get_browser().get_user_agent(),
+                workers=self.http_workers,
+                sessions=self.sessions
+            )
+        return self.http_resolver
+
+    def _discover(self):
+        while True:
+            job = self.pending.get()
+            if job is None:
+                break
+            try:
+                if not job.cancelled.is_set():
+                    queue_entries(
+                        job.entries, self.scheduler, self._get_browser, self.discovery_stats,
+                        tabs=self.tabs, get_http_resolver=self._get_http_resolver, cache=self.cache,
+                        manifest=self.manifest, crawl_depth=self.crawl_depth, follow=self.follow, job=job
+                    )
+            except BrowserConnectionError as e:
+                # Try to connect again for the next job, Chrome may have been restarted
+                print(e)
+                job.error = str(e)
+            except Exception as e:
+                print(f"Job {job.id}: error during discovery: {e}")
+                job.error = str(e)
+            finally:
+                job.discovering = False
+
+    def _sample(self):
+        while not self.stopping.wait(1.0):
+            for job in self.all_jobs():
+                if not job.finished:
+                    job.sample()
+
+    def serve(self, port):
+        """Serve the HTTP API on 127.0.0.1:port until interrupted"""
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if not self._local():
+                    return
+                parts = self.path.split("?")[0].strip("/").split("/")
+                if parts == ["jobs"]:
+                    return self._send(200, [job.progress(details=False) for job in service.all_jobs()])
+                job = service.jobs.get(parts[1]) if len(parts) == 2 and parts[0] == "jobs" else None
+                if job:
+                    return self._send(200, job.progress())
+                if parts == ["status"]:
+                    return self._send(200, service.status())
+                self._send(404, {"error": "not found"})
+
+            def do_POST(self):
+                if not self._local():
+                    return
+                parts = self.path.split("?")[0].strip("/").split("/")
+                if len(parts) == 3 and parts[0] == "jobs" and parts[2] == "cancel":
+                    return self._cancel(parts[1])
+                if parts != ["jobs"]:
+                    return self._send(404, {"error": "not found"})
+                if self._content_type() not in ("application/json", "text/plain"):
+                    return self._send(415, {"error": "send JSON as application/json or a batch file as text/plain"})
+                try:
+                    entries = self._read_entries()
+                except ValueError as e:
+                    return self._send(400, {"error": str(e)})
+                if not entries:
+                    return self._send(400, {"error": "no entries"})
+                self._send(201, service.submit(entries).progress())
+
+            def do_DELETE(self):
+                if not self._local():
+                    return
+                parts = self.path.split("?")[0].strip("/").split("/")
+                if len(parts) == 2 and parts[0] == "jobs":
+                    return self._cancel(parts[1])
+                self._send(404, {"error": "not found"})
+
+            def _cancel(self, job_id):
+                job = service.cancel(job_id)
+                if not job:
+                    return self._send(404, {"error": f"no job {job_id}"})
+                self._send(200, job.progress(details=False))
+
+            def _local(self):
+                """Refuse requests from web pages, which any site the user visits could send.
+
+                Browsers add an Origin header to cross-site requests, and a
+                Host other than the one we listen on means DNS rebinding.
+                """
+                port = self.server.server_address[1]
+                hosts = (f"127.0.0.1:{port}", f"localhost:{port}")
+                origin = self.headers.get("Origin")
+                if self.headers.get("Host") not in hosts or (origin is not None and origin not in
+                                                              tuple(f"http://{host}" for host in hosts)):
+                    self._send(403, {"error": "only local clients may use this API"})
+                    return False
+                return True
+
+            def _content_type(self):
+                return (self.headers.get("Content-Type") or "").split(";")[0].strip().lower()
+
+            def _read_entries(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0)).decode("utf8")
+                # JSON only as application/json: a web page can't send that without a CORS preflight
+                if self._content_type() == "text/plain":
+                    return parse_batch(body.splitlines(), service.output_path)
+                try:
+                    data = json.loads(body)
+                except ValueError as e:
+                    raise ValueError(f"invalid JSON: {e}")
+                entries = []
+                for item in data if isinstance(data, list) else [data]:
+                    if not isinstance(item, dict) or not item.get("url"):
+                        raise ValueError("every entry needs a url")
+                    kind = item.get("kind") or ("index" if item.get("base_url") else None)
+                    rest = item.get("base_url") if kind == "index" else item.get("name", "")
+                    entries.append(batch_entry(kind, item["url"], rest or "", service.output_path,
+                                               len(service.jobs) + len(entries) + 1))
+                return entries
+
+            def _send(self, status, data):
+                body = json.dumps(data, indent=1).encode("utf8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        print(f"Serving the job API on http://127.0.0.1:{port}/jobs")
+        try:
+            self.server.serve_forever()
+        except KeyboardInterrupt:
+            print("\nShutting down")
+        finally:
+            self.server.server_close()
+
+    def close(self):
+        """Cancel queued work, wait for running downloads to stop and release everything"""
+        for job in self.all_jobs():
+            job.cancel()
+        self.pending.put(None)
+        self.stopping.set()
+        for thread in self.threads:
+            thread.join()
+        self.scheduler.close(cancel=True)
+        if self.http_resolver:
+            self.http_resolver.close()
+        self.sessions.close()
+        if self.browser and self.own_browser:
+            self.browser.cleanup()
+        if self.cache:
+            self.cache.close()
+        self.manifest.save()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Download BunnyCDN videos from multiple pages")
-    parser.add_argument("main_url", help="URL of the webpage containing links")
-    parser.add_argument("base_url", help="Base URL to filter links by")
+    parser.add_argument("main_url", nargs="?", help="URL of the webpage containing links")
+    parser.add_argument("base_url", nargs="?", help="Base URL to filter links by")
+    parser.add_argument("--batch", help="File listing index pages, lesson pages and embed URLs to download in one run ('-' for stdin)")
     parser.add_argument("-o", "--output", help="Output directory for downloaded videos", default=".")
     parser.add_argument("-p", "--port", type=int, help="Chrome debugging port (default: 9222)", default=9222)
+    parser.add_argument("-j", "--jobs", type=int, help="Number of videos to download at once (default: 1)", default=1)
+    parser.add_argument("--max-connections", type=int, help="Total fragment connections across all jobs (default: 32)", default=32)
+    parser.add_argument("--tabs", type=int, help="Number of browser tabs used to look for embeds in parallel (default: 1)", default=1)
+    parser.add_argument("--crawl-depth", type=int, help="Follow 'next page' and --follow links on index pages this many levels deep (default: 0)", default=0)
+    parser.add_argument("--follow", help="Also crawl index links containing this string, e.g. '/modules/' (with --crawl-depth)")
+    parser.add_argument("--http-discovery", action="store_true", help="Fetch lesson pages over HTTP with the browser's cookies, using tabs only when needed")
+    parser.add_argument("--http-workers", type=int, help="Parallel HTTP page fetches with --http-discovery (default: 8)", default=8)
+    parser.add_argument("--timeout", type=float, help="Seconds to wait for a page to finish loading (default: 15)")
+    parser.add_argument("--ready-selector", help="CSS selector that marks a page as ready")
+    parser.add_argument("--profiles", help="JSON file with per-site readiness timeouts and selectors")
+    parser.add_argument("--no-cache", action="store_true", help="Don't read or write the resolution cache in the output directory")
+    parser.add_argument("--refresh-cache", action="store_true", help="Re-resolve links and embeds even if cached (finished videos are still skipped)")
+    parser.add_argument("--engine", choices=["yt-dlp", "native"], help="Segment downloader to use (default: yt-dlp)", default="yt-dlp")
+    parser.add_argument("--no-preallocate", action="store_true", help="Don't reserve each file's expected size on disk before downloading it (native engine)")
+    parser.add_argument("--max-rate", help="Total download rate limit in bytes per second, e.g. 5M (default: unlimited)")
+    parser.add_argument("--job-rate", help="Download rate limit for each job or batch entry, e.g. 2M")
+    parser.add_argument("--rate-schedule", help="Time-of-day rate limits replacing --max-rate, e.g. '09:00-18:00=2M,18:00-23:00=0'")
+    parser.add_argument("--schedule", choices=FairQueue.policies, help="Order in which videos from different jobs or batch entries get a download slot (default: fifo)", default="fifo")
+    parser.add_argument("--quality", help="Rendition policy: best, maxheight=720, maxbitrate=3M, budget=50G (comma separated)", default="best")
+    parser.add_argument("--resume", action="store_true", help="Continue interrupted downloads from the job manifest, at the fragment level")
+    parser.add_argument("--metrics-jsonl", help="Append timing spans and counters to this JSON-lines file")
+    parser.add_argument("--metrics-prom", help="Keep Prometheus text-format metrics up to date in this file")
+    parser.add_argument("--metrics-port", type=int, help="Serve Prometheus metrics on http://127.0.0.1:PORT/metrics")
+    parser.add_argument("--queue-size", type=int, help="Resolved videos waiting for a download slot (default: same as --jobs)", default=0)
+    parser.add_argument("--profile-startup", action="store_true", help="Report how long each dependency took to import")
+    parser.add_argument("--serve", type=int, metavar="PORT", help="Run as a service, taking jobs over HTTP on 127.0.0.1:PORT")
 
     args = parser.parse_args()
 
+    if args.profile_startup:
+        print("Startup imports:")
+        for line in startup_report():
+            print(f"  {line}")
+
+    entries = []
+    if args.main_url or args.base_url:
+        if not (args.main_url and args.base_url):
+            parser.error("main_url and base_url must be given together")
+        entries.append({"kind": "index", "url": args.main_url, "base_url": args.base_url, "path": args.output})
+    if args.batch:
+        try:
+            if args.batch == "-":
+                entries += parse_batch(sys.stdin, args.output)
+            else:
+                with open(args.batch) as f:
+                    entries += parse_batch(f, args.output)
+        except (OSError, ValueError) as e:
+            parser.error(f"Can't read batch file {args.batch}: {e}")
+    try:
+        policy = QualityPolicy.parse(args.quality)
+        rate_limiter = RateLimiter.parse(args.max_rate, args.job_rate, args.rate_schedule)
+    except ValueError as e:
+        parser.error(str(e))
+    if not entries and not args.serve:
+        if args.profile_startup:
+            sys.exit(0)
+        parser.error("give main_url and base_url, or --batch")
+
     print("BunnyCDN Video Downloader")
-    print(f"Main URL: {args.main_url}")
-    print(f"Base URL filter: {args.base_url}")
+    if args.main_url:
+        print(f"Main URL: {args.main_url}")
+        print(f"Base URL filter: {args.base_url}")
+    if args.batch:
+        print(f"Batch: {len(entries)} entries from {args.batch}")
     print(f"Output directory: {args.output}")
     print(f"Chrome debugging port: {args.port}")
+    print(f"Parallel jobs: {args.jobs}")
+    if args.max_rate or args.job_rate or args.rate_schedule:
+        print(f"Bandwidth limit: {format_rate(rate_limiter.allowed())} now"
+              + (f", {format_rate(rate_limiter.job_rate)} per job" if rate_limiter.job_rate else ""))
     print("-" * 50)
 
-    download_videos(
-        args.main_url,
-        args.base_url,
-        args.output,
-        debug_port=args.port
+    metrics.configure(args.metrics_jsonl, args.metrics_prom, args.metrics_port)
+
+    options = dict(
+        debug_port=args.port,
+        jobs=args.jobs,
+        max_connections=args.max_connections,
+        queue_size=args.queue_size,
+        profiles=load_readiness_profiles(args.profiles, args.timeout, args.ready_selector),
+        tabs=args.tabs,
+        http_discovery=args.http_discovery,
+        http_workers=args.http_workers,
+        use_cache=not args.no_cache,
+        refresh_cache=args.refresh_cache,
+        resume=args.resume,
+        engine=args.engine,
+        policy=policy,
+        crawl_depth=args.crawl_depth,
+        follow=args.follow,
+        preallocate=not args.no_preallocate,
+        rate_limiter=rate_limiter,
+        schedule=args.schedule
     )
+    try:
+        if args.serve:
+            service = DownloadService(args.output, **options)
+            try:
+                service.start()
+                if entries:
+                    service.submit(entries)
+                service.serve(args.serve)
+            finally:
+                service.close()
+        else:
+            download_batch(entries, args.output, **options)
+    except BrowserConnectionError as e:
+        print(e)
+        sys.exit(1)
+    finally:
+        metrics.close()
+        if args.profile_startup:
+            print("Imports, including those loaded during the run:")
+            for line in startup_report()[:-1]:
+                print(f"  {line}")
@@ -0,0 +1,11 @@
+import bvd
+
+
+def test_retry_sleep_is_called_like_yt_dlp():
+    backend = bvd.YtDlpBackend()
+    before = bvd.metrics.counters.get(("retries", (("engine", "yt-dlp"),)), 0)
+    for n in range(3):
+        # yt-dlp's report_retry calls sleep_func(n=count - 1)
+        delay = backend.retry_sleep(n=n)
+        assert 0 <= delay <= min(30.0, 0.5 * 2 ** n)
+    assert bvd.metrics.counters[("retries", (("engine", "yt-dlp"),))] == before + 3